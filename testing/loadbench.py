@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+#
+# End-to-end HTTP load benchmark.
+#
+#    make throwaway CA, server and client certificates
+#    start InfoService locally with chosen persistence plugin
+#    drive a mix of User entity GET/POST/PUT/DELETE from N concurrent clients
+#    print throughput and latency percentiles as JSON
+#
+#  ./loadbench.py --plugin SQLite --workers 4 --clients 16 --duration 30 --mix GET=70,POST=10,PUT=15,DELETE=5
+#
+
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+
+(libpath, tail) = os.path.split(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, libpath)
+
+from vc3infoservice import infoclient
+from vc3infoservice.core import InfoEntityMissingException, InfoEntityExistsException, InfoEntityUpdateMissingException
+
+from testentities import User
+
+OPS = ['GET', 'POST', 'PUT', 'DELETE']
+
+
+def makecerts(certdir):
+    '''
+    Creates a self-signed CA in <certdir> and uses it to sign a 'localhost' server certificate
+    and a client certificate. Returns dict of pem file paths.
+    '''
+    def openssl(*args):
+        subprocess.check_call(('openssl',) + args, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    p = lambda name: os.path.join(certdir, name)
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2', '-subj', '/CN=InfoService Bench CA',
+            '-keyout', p('ca.key.pem'), '-out', p('ca.cert.pem'))
+    open(p('san.ext'), 'w').write('subjectAltName=DNS:localhost,IP:127.0.0.1\n')
+    for (name, cn) in [('localhost', 'localhost'), ('client', 'VC3Admin')]:
+        openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=%s' % cn,
+                '-keyout', p('%s.key.pem' % name), '-out', p('%s.csr' % name))
+        openssl('x509', '-req', '-days', '2', '-in', p('%s.csr' % name), '-CA', p('ca.cert.pem'),
+                '-CAkey', p('ca.key.pem'), '-CAcreateserial', '-extfile', p('san.ext'),
+                '-out', p('%s.cert.pem' % name))
+    return { 'chainfile'  : p('ca.cert.pem'),
+             'certfile'   : p('localhost.cert.pem'),
+             'keyfile'    : p('localhost.key.pem'),
+             'clientcert' : p('client.cert.pem'),
+             'clientkey'  : p('client.key.pem') }
+
+
+def makeconfigs(options, workdir, certs):
+    '''
+    Returns (serviceconfig, clientconfig). The service config is read from options.conf,
+    with netcomm and persistence pointed at <workdir>.
+    '''
+    scp = ConfigParser()
+    scp.read(options.conf)
+    for section in ['netcomm', 'persistence', 'plugin-diskdump', 'plugin-sqlite', 'plugin-memory']:
+        if not scp.has_section(section):
+            scp.add_section(section)
+    scp.set('netcomm', 'chainfile', certs['chainfile'])
+    scp.set('netcomm', 'certfile', certs['certfile'])
+    scp.set('netcomm', 'keyfile', certs['keyfile'])
+    scp.set('netcomm', 'sslmodule', options.sslmodule)
+    scp.set('netcomm', 'httpport', str(options.port - 1))
+    scp.set('netcomm', 'httpsport', str(options.port))
+    scp.set('netcomm', 'workers', str(options.workers))
+    scp.set('netcomm', 'writersocket', os.path.join(workdir, 'writer.sock'))
+    if options.unix:
+        scp.set('netcomm', 'unixsocket', os.path.join(workdir, 'infoservice.sock'))
+    scp.set('persistence', 'plugin', options.plugin)
+    scp.set('plugin-diskdump', 'filename', os.path.join(workdir, 'infoservice.diskdump'))
+    scp.set('plugin-sqlite', 'filename', os.path.join(workdir, 'infoservice.sqlite'))
+
+    ccp = ConfigParser()
+    ccp.add_section('netcomm')
+    ccp.set('netcomm', 'chainfile', certs['chainfile'])
+    ccp.set('netcomm', 'certfile', certs['clientcert'])
+    ccp.set('netcomm', 'keyfile', certs['clientkey'])
+    ccp.set('netcomm', 'infohost', 'localhost')
+    ccp.set('netcomm', 'httpport', str(options.port - 1))
+    ccp.set('netcomm', 'httpsport', str(options.port))
+    if options.unix:
+        ccp.set('netcomm', 'infosocket', os.path.join(workdir, 'infoservice.sock'))
+    return (scp, ccp)
+
+
+def runservice(config, loglevel):
+    '''
+    Service process body.
+    '''
+    logging.basicConfig(level=loglevel)
+    from vc3infoservice.infoservice import InfoService
+    import cherrypy
+    cherrypy.config.update({'log.screen' : False, 'engine.autoreload.on' : False})
+    InfoService(config).run()
+
+
+def waitforport(port, timeout):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            s = socket.create_connection(('localhost', port), 1)
+            s.close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("InfoService did not listen on port %d within %d seconds" % (port, timeout))
+
+
+def parsemix(mixstr):
+    '''
+    'GET=70,PUT=30' -> [('GET', 0.7), ('PUT', 1.0)], cumulative for random selection.
+    '''
+    weights = []
+    for item in mixstr.split(','):
+        (op, w) = item.split('=')
+        op = op.strip().upper()
+        if op not in OPS:
+            raise ValueError("Unknown operation %s in mix. Valid: %s" % (op, ', '.join(OPS)))
+        weights.append((op, float(w)))
+    total = sum([ w for (op, w) in weights ])
+    mix = []
+    acc = 0.0
+    for (op, w) in weights:
+        acc += w / total
+        mix.append((op, acc))
+    return mix
+
+
+def makeuser(name):
+    u = User( name = name,
+              state = 'new',
+              acl = None,
+              first = 'First',
+              last = 'Last',
+              email = '%s@somewhere.org' % name,
+              organization = 'somewhere.org',
+              description = 'A short description',
+              displayname = 'First Last',
+              url = 'http://www.somewhere.org/%s' % name,
+              docurl = 'http://www.somewhere.org/docs' )
+    u.storenew = True
+    return u
+
+
+class BenchClient(threading.Thread):
+    '''
+    One concurrent client: own InfoClient, own result lists.
+    '''
+    def __init__(self, config, names, mix, deadline):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ic = infoclient.InfoClient(config)
+        self.names = names
+        self.mix = mix
+        self.deadline = deadline
+        self.latencies = dict([ (op, []) for op in OPS ])
+        self.rejected = dict([ (op, 0) for op in OPS ])
+        self.errors = dict([ (op, 0) for op in OPS ])
+
+    def run(self):
+        while time.time() < self.deadline:
+            op = self.pickop()
+            name = random.choice(self.names)
+            start = time.time()
+            try:
+                self.doop(op, name)
+            except (InfoEntityMissingException, InfoEntityExistsException, InfoEntityUpdateMissingException):
+                # the random op found the entity in the wrong state, e.g. POST of an existing user
+                self.rejected[op] += 1
+            except Exception:
+                self.errors[op] += 1
+            self.latencies[op].append(time.time() - start)
+
+    def pickop(self):
+        r = random.random()
+        for (op, acc) in self.mix:
+            if r < acc:
+                return op
+        return self.mix[-1][0]
+
+    def doop(self, op, name):
+        if op == 'GET':
+            self.ic.getentity(User, name)
+        elif op == 'POST':
+            makeuser(name).store(self.ic)
+        elif op == 'PUT':
+            u = makeuser(name)
+            del u.storenew
+            u.email = 'changed%d@somewhere.org' % random.randint(0, 1000000)
+            u.store(self.ic)
+        elif op == 'DELETE':
+            self.ic.deleteentity(User, name)
+
+
+def percentile(sortedvalues, pct):
+    if not sortedvalues:
+        return None
+    i = min(len(sortedvalues) - 1, int(len(sortedvalues) * pct / 100.0))
+    return sortedvalues[i]
+
+
+def summarize(latencies):
+    '''
+    Milliseconds.
+    '''
+    s = sorted(latencies)
+    return { 'p50'  : round(percentile(s, 50) * 1000, 3) if s else None,
+             'p99'  : round(percentile(s, 99) * 1000, 3) if s else None,
+             'mean' : round(sum(s) / len(s) * 1000, 3) if s else None,
+             'max'  : round(s[-1] * 1000, 3) if s else None }
+
+
+def bench(options):
+    log = logging.getLogger()
+    workdir = tempfile.mkdtemp(prefix='infobench-')
+    service = None
+    try:
+        certs = makecerts(workdir)
+        (scp, ccp) = makeconfigs(options, workdir, certs)
+        service = multiprocessing.Process(target=runservice, args=(scp, options.loglevel))
+        service.start()
+        waitforport(options.port, 30)
+        log.info("InfoService with %s plugin, %d workers listening on %d" % (options.plugin, options.workers, options.port))
+
+        names = [ 'benchuser%06d' % i for i in range(options.entities) ]
+        ic = infoclient.InfoClient(ccp)
+        for name in names:
+            makeuser(name).store(ic)
+        log.info("Preloaded %d users." % len(names))
+
+        mix = parsemix(options.mix)
+        start = time.time()
+        clients = [ BenchClient(ccp, names, mix, start + options.duration) for i in range(options.clients) ]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.time() - start
+
+        result = { 'plugin'   : options.plugin,
+                   'workers'  : options.workers,
+                   'unix'     : options.unix,
+                   'clients'  : options.clients,
+                   'entities' : options.entities,
+                   'mix'      : options.mix,
+                   'duration' : round(elapsed, 3),
+                   'ops'      : {} }
+        alllatencies = []
+        for op in OPS:
+            latencies = []
+            for c in clients:
+                latencies.extend(c.latencies[op])
+            if not latencies:
+                continue
+            alllatencies.extend(latencies)
+            opresult = summarize(latencies)
+            opresult['count'] = len(latencies)
+            opresult['rejected'] = sum([ c.rejected[op] for c in clients ])
+            opresult['errors'] = sum([ c.errors[op] for c in clients ])
+            opresult['throughput'] = round(len(latencies) / elapsed, 2)
+            result['ops'][op] = opresult
+        result['requests'] = len(alllatencies)
+        result['throughput'] = round(len(alllatencies) / elapsed, 2)
+        result.update(summarize(alllatencies))
+        return result
+    finally:
+        if service is not None and service.is_alive():
+            service.terminate()
+            service.join()
+        if options.keep:
+            log.info("Kept working directory %s" % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='''%prog [OPTIONS]
+Runs a local InfoService and reports entity request throughput and latency as JSON.''')
+    parser.add_option("--plugin", dest="plugin", default="Memory",
+                      help="Persistence plugin: Memory, DiskDump, SQLite [default Memory]")
+    parser.add_option("--workers", dest="workers", type="int", default=0,
+                      help="Prefork worker processes, 0 for a single process [default 0]")
+    parser.add_option("--unix", dest="unix", default=False, action="store_true",
+                      help="Clients connect over the service's unix socket instead of HTTPS")
+    parser.add_option("--clients", dest="clients", type="int", default=8,
+                      help="Concurrent clients [default 8]")
+    parser.add_option("--duration", dest="duration", type="float", default=10.0,
+                      help="Seconds to run [default 10]")
+    parser.add_option("--entities", dest="entities", type="int", default=200,
+                      help="User entities preloaded and operated on [default 200]")
+    parser.add_option("--mix", dest="mix", default="GET=70,POST=10,PUT=15,DELETE=5",
+                      help="Operation weights [default GET=70,POST=10,PUT=15,DELETE=5]")
+    parser.add_option("--port", dest="port", type="int", default=20434,
+                      help="HTTPS port for the benchmark service [default 20434]")
+    parser.add_option("--conf", dest="conf",
+                      default=os.path.join(libpath, 'etc', 'vc3-infoservice.conf'),
+                      help="Service config to start from [default etc/vc3-infoservice.conf]")
+    parser.add_option("--sslmodule", dest="sslmodule", default="pyopenssl",
+                      help="CherryPy ssl module: pyopenssl or builtin [default pyopenssl]")
+    parser.add_option("--keep", dest="keep", default=False, action="store_true",
+                      help="Keep certificates and data files")
+    parser.add_option("-d", "--debug", dest="loglevel", default=logging.WARNING,
+                      action="store_const", const=logging.DEBUG, help="Set logging level to DEBUG")
+    parser.add_option("-v", "--info", dest="loglevel", default=logging.WARNING,
+                      action="store_const", const=logging.INFO, help="Set logging level to INFO")
+    (options, args) = parser.parse_args()
+
+    FORMAT='%(asctime)s (UTC) [ %(levelname)s ] %(name)s %(filename)s:%(lineno)d %(funcName)s(): %(message)s'
+    logging.basicConfig(format=FORMAT)
+    logging.getLogger().setLevel(options.loglevel)
+    # per-request urllib3 chatter would dominate client time
+    logging.getLogger('requests').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    print(json.dumps(bench(options), indent=4, sort_keys=True))
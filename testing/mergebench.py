@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Microbenchmarks of document merge and DiskDump snapshot scaling.
+#
+#    merge.entities    InfoHandler.merge of an update to every entity into an N entity document
+#    merge.lists       InfoHandler.merge of an L item list into an L item list (half new items)
+#    merge.dictlists   as merge.lists, with unhashable (dict) list items
+#    entitymerge       InfoHandler.entitymerge of each entity of an N entity update
+#    diskdump.store    DiskDump dump_db + store_db of an N entity document
+#    diskdump.load     DiskDump load_db of the snapshot written above
+#
+#  Prints, per benchmark, the best-of-repeat time of each size and the fitted scaling
+#  exponent (seconds ~ size^exponent) as JSON. A curve stops growing once its next run is
+#  predicted to take longer than --maxseconds.
+#
+#  ./mergebench.py --entities 10,1000,100000 --lists 10,1000,100000 --repeat 3
+#
+
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+
+(libpath, tail) = os.path.split(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, libpath)
+
+from vc3infoservice.infoservice import InfoHandler
+from vc3infoservice.plugins.persist.DiskDump import DiskDump
+
+
+def makeentity(i):
+    '''
+    User-like entity.
+    '''
+    name = 'user%07d' % i
+    return { 'name' : name,
+             'state' : 'new',
+             'acl' : None,
+             'first' : 'First',
+             'last' : 'Last',
+             'email' : '%s@somewhere.org' % name,
+             'organization' : 'somewhere.org',
+             'allocations' : [ '%s.allocation%d' % (name, j) for j in range(3) ] }
+
+
+def makedocument(n):
+    doc = {}
+    for i in range(n):
+        e = makeentity(i)
+        doc[e['name']] = e
+    return doc
+
+
+def makeupdate(n):
+    '''
+    Changes one attribute and adds one allocation to every entity of makedocument(n).
+    '''
+    update = {}
+    for i in range(n):
+        name = 'user%07d' % i
+        update[name] = { 'email' : 'changed.%s@somewhere.org' % name,
+                         'allocations' : [ '%s.allocation%d' % (name, 3) ] }
+    return update
+
+
+def makelists(n, dicts=False):
+    '''
+    Returns (src, dest) lists of n items each, half of src not in dest.
+    '''
+    if dicts:
+        item = lambda i: { 'name' : 'item%d' % i, 'value' : i }
+    else:
+        item = lambda i: 'item%d' % i
+    dest = [ item(i) for i in range(n) ]
+    src = [ item(i) for i in range(n / 2, n + n / 2) ]
+    return (src, dest)
+
+
+def timeit(setup, run, repeat):
+    '''
+    Best of <repeat> timings of run(*setup()), setup not timed.
+    '''
+    best = None
+    for i in range(repeat):
+        args = setup()
+        start = time.time()
+        run(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def exponent(points):
+    '''
+    Least squares slope of log(seconds) over log(size).
+    '''
+    xy = [ (math.log(p['size']), math.log(p['seconds'])) for p in points if p['seconds'] > 0 ]
+    if len(xy) < 2:
+        return None
+    mx = sum([ x for (x, y) in xy ]) / len(xy)
+    my = sum([ y for (x, y) in xy ]) / len(xy)
+    sxx = sum([ (x - mx) ** 2 for (x, y) in xy ])
+    if sxx == 0:
+        return None
+    return round(sum([ (x - mx) * (y - my) for (x, y) in xy ]) / sxx, 3)
+
+
+def curve(name, sizes, setup, run, options):
+    log = logging.getLogger()
+    points = []
+    for (i, size) in enumerate(sizes):
+        seconds = timeit(lambda: setup(size), run, options.repeat)
+        points.append({ 'size' : size,
+                        'seconds' : round(seconds, 6),
+                        'usperunit' : round(seconds * 1000000 / size, 3) })
+        log.info("%s size %d: %.6f s" % (name, size, seconds))
+        if i + 1 < len(sizes):
+            # extrapolate along the curve so far, at least linearly
+            predicted = seconds * (float(sizes[i + 1]) / size) ** max(1.0, exponent(points) or 1.0)
+            if predicted > options.maxseconds:
+                log.info("%s stopped after size %d, next predicted %.1f s" % (name, size, predicted))
+                break
+    return { 'points' : points,
+             'exponent' : exponent(points),
+             'skipped' : [ s for s in sizes if s > points[-1]['size'] ] }
+
+
+def bench(options):
+    workdir = tempfile.mkdtemp(prefix='infomergebench-')
+    try:
+        cp = ConfigParser()
+        for section in ['persistence', 'plugin-memory', 'plugin-diskdump']:
+            cp.add_section(section)
+        cp.set('persistence', 'plugin', 'Memory')
+        cp.set('plugin-diskdump', 'filename', os.path.join(workdir, 'infoservice.diskdump'))
+        handler = InfoHandler(cp)
+        diskdump = DiskDump(handler, cp, 'plugin-diskdump')
+
+        entitysizes = [ int(s) for s in options.entities.split(',') ]
+        listsizes = [ int(s) for s in options.lists.split(',') ]
+        benchmarks = options.benchmarks.split(',')
+        result = {}
+
+        def entitymerges(update, doc):
+            for ename in update:
+                handler.entitymerge(update[ename], doc[ename])
+
+        def storedump(doc):
+            diskdump.store_db(diskdump.dump_db({ 'user' : doc }))
+
+        def loadsetup(n):
+            storedump(makedocument(n))
+            return ()
+
+        runs = { 'merge.entities' : (entitysizes, lambda n: (makeupdate(n), makedocument(n)), handler.merge),
+                 'merge.lists' : (listsizes, lambda n: makelists(n), handler.merge),
+                 'merge.dictlists' : (listsizes, lambda n: makelists(n, dicts=True), handler.merge),
+                 'entitymerge' : (entitysizes, lambda n: (makeupdate(n), makedocument(n)), entitymerges),
+                 'diskdump.store' : (entitysizes, lambda n: (makedocument(n),), storedump),
+                 'diskdump.load' : (entitysizes, loadsetup, diskdump.load_db) }
+        for name in benchmarks:
+            (sizes, setup, run) = runs[name]
+            result[name] = curve(name, sizes, setup, run, options)
+        diskdump.shutdown()
+        handler.shutdown()
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='''%prog [OPTIONS]
+Reports scaling of InfoHandler.merge, InfoHandler.entitymerge and DiskDump snapshot
+store/load with document size as JSON.''')
+    parser.add_option("--entities", dest="entities", default="10,100,1000,10000,100000,1000000",
+                      help="Document sizes in entities [default 10,...,1000000]")
+    parser.add_option("--lists", dest="lists", default="10,100,1000,10000,100000",
+                      help="List lengths [default 10,...,100000]")
+    parser.add_option("--benchmarks", dest="benchmarks",
+                      default="merge.entities,merge.lists,merge.dictlists,entitymerge,diskdump.store,diskdump.load",
+                      help="Comma separated benchmarks to run [default all]")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="Runs per size, best is reported [default 3]")
+    parser.add_option("--maxseconds", dest="maxseconds", type="float", default=30.0,
+                      help="Stop a curve before a run predicted to take longer [default 30]")
+    parser.add_option("-d", "--debug", dest="loglevel", default=logging.WARNING,
+                      action="store_const", const=logging.DEBUG, help="Set logging level to DEBUG")
+    parser.add_option("-v", "--info", dest="loglevel", default=logging.WARNING,
+                      action="store_const", const=logging.INFO, help="Set logging level to INFO")
+    (options, args) = parser.parse_args()
+
+    FORMAT='%(asctime)s (UTC) [ %(levelname)s ] %(name)s %(filename)s:%(lineno)d %(funcName)s(): %(message)s'
+    logging.basicConfig(format=FORMAT)
+    logging.getLogger().setLevel(options.loglevel)
+
+    print(json.dumps(bench(options), indent=4, sort_keys=True))
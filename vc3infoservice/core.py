@@ -12,6 +12,9 @@ __status__ = "Production"
 import logging
 import random
 import string
+import threading
+
+from ConfigParser import NoOptionError, NoSectionError
 
 class InfoConnectionFailure(Exception):
     '''
@@ -63,6 +66,16 @@ class InfoEntityUpdateMissingException(Exception):
     def __str__(self):
         return repr(self.value) 
 
+class InfoEntityVersionException(Exception):
+    '''
+    Exception thrown when a conditional update or delete is refused because the 
+    entity was changed since the version the client holds. Entity must be re-read. 
+    '''
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value) 
+
 class InfoAttributeFacade(object):
     '''
     Intercepts __setattr__ one level down for InfoEntities. 
@@ -105,6 +118,8 @@ class InfoEntity(object):
 
     '''
     infokey = 'unset'
+    # ETag of the version this object was read from, if any. See store(checkversion=True). 
+    infoetag = None
     infoattributes = []
     intattributes = []
     validvalues = {}
@@ -205,9 +220,14 @@ class InfoEntity(object):
         self.state = newstate
     
 
-    def store(self, infoclient):
+    def store(self, infoclient, checkversion=False):
         '''
         Updates this Info Entity in store behind given infoclient. 
+        With checkversion, an update is only made if the entity is unchanged since this 
+        object was read, raising InfoEntityVersionException otherwise, or if the object 
+        was not read from the infoservice and has no version to check. A new entity is 
+        only created if none of its name exists, raising InfoEntityExistsException 
+        otherwise, with or without checkversion. 
         '''
         keystr = self.__class__.infokey
         validvalues = self.__class__.validvalues
@@ -225,9 +245,29 @@ class InfoEntity(object):
         else:
             entdict = self.makeDictObject(newonly=True)
             self.log.debug("Dict obj: %s" % entdict)
-            infoclient._mergeentitydict(keystr, entdict )
+            if checkversion:
+                if self.infoetag is None:
+                    raise InfoEntityVersionException("No version of %s entity %s to check. Read it first." % (self.__class__.__name__, 
+                                                                                                              self.name))
+                etag = infoclient._mergeentitydict(keystr, entdict, self.infoetag)
+            else:
+                etag = infoclient._mergeentitydict(keystr, entdict)
+            self.infoetag = etag
         self.log.debug("Stored entity %s in key %s" % (self.name, keystr))
 
+    def makeBatchOp(self):
+        '''
+        Returns the operation store() would perform, for InfoClient.batch(). 
+        '''
+        if hasattr(self, 'storenew'):
+            (op, entdict) = ('create', self.makeDictObject(newonly=False))
+        else:
+            (op, entdict) = ('merge', self.makeDictObject(newonly=True))
+        return { 'op' : op, 
+                 'key' : self.__class__.infokey, 
+                 'entityname' : self.name, 
+                 'entity' : entdict[self.name] }
+
     def addAcl(self, aclstring):
         pass    
 
@@ -269,7 +309,7 @@ class InfoEntity(object):
         
 
     @classmethod
-    def objectFromDict(cls, dict):
+    def objectFromDict(cls, dict, partial=False):
         '''
         Returns an initialized Entity object from dictionary. 
         Input: Dict:
@@ -278,6 +318,8 @@ class InfoEntity(object):
                 "att1" : "<val1>"  
             }
 
+        With partial, the dictionary is a projection (fields) expected to lack attributes, 
+        which are set to None without warning. 
         '''
         log = logging.getLogger()
         log.debug("Making object from dictionary...")
@@ -290,7 +332,8 @@ class InfoEntity(object):
                 args[key] = d[key]
             except KeyError, e:
                 args[key] = None
-                log.warning("Document object does not have a '%s' key" % e.args[0])
+                if not partial:
+                    log.warning("Document object does not have a '%s' key" % e.args[0])
         for key in cls.intattributes:
             try:
                 if args[key] is not None:
@@ -324,22 +367,219 @@ class InfoPersistencePlugin(object):
 
     def __init__(self, parent, config, section ):
         self.log = logging.getLogger()
-        self.lock = MockLock()
         self.parent = parent
         self.config = config
         self.section = section
+        try:
+            entitylocks = config.getboolean('persistence', 'entitylocks')
+        except (NoOptionError, NoSectionError):
+            entitylocks = False
+        self.locks = InfoLockManager(entitylocks=entitylocks)
 
-class MockLock(object):
+    def getentity(self, key, entityname):
+        '''
+        Returns Python entity <entityname> from document <key>. Raises KeyError if missing. 
+        Back ends that can address single entities should override the entity methods, so 
+        entity operations do not need to read and write the whole document. 
+        '''
+        return self.getdocument(key)[entityname]
+
+    def storeentity(self, key, entityname, entity):
+        '''
+        Stores (creates or replaces) Python entity <entityname> in document <key>. 
+        '''
+        doc = dict(self.getdocument(key))
+        doc[entityname] = entity
+        self.storedocument(key, doc)
+
+    def deleteentity(self, key, entityname):
+        '''
+        Removes entity <entityname> from document <key>. Raises KeyError if missing. 
+        '''
+        doc = dict(self.getdocument(key))
+        doc.pop(entityname)
+        self.storedocument(key, doc)
+
+    def storeentities(self, key, changes):
+        '''
+        Applies <changes>, a dict of entityname -> Python entity, or None to remove the entity,
+        to document <key> as one write. 
+        '''
+        doc = dict(self.getdocument(key))
+        for (entityname, entity) in changes.items():
+            if entity is None:
+                doc.pop(entityname, None)
+            else:
+                doc[entityname] = entity
+        self.storedocument(key, doc)
+
+    def getsnapshot(self):
+        '''
+        Returns an object with getdocument()/getentity() for reading. Back ends keeping
+        versioned documents return an InfoSnapshot, pinning one consistent version of all keys. 
+        Others return themselves, so reads see the live store. 
+        '''
+        return self
+
+    def sync(self):
+        '''
+        Called by the handler after a write, outside of any lock. Back ends that write 
+        asynchronously may block here until the calling thread's changes are durable. 
+        '''
+        pass
+
+    def shutdown(self):
+        '''
+        Called when the service stops. Back ends holding unwritten state should flush it here. 
+        '''
+        pass
+
+class InfoSnapshot(object):
     '''
-    Provided as a convenience for persistence back ends that don't require atomic operations. 
-    ''' 
+    Immutable view of all documents as of one store version. 
     
+    A published snapshot, and every document and entity reachable from it, is never modified. 
+    The with*() methods return a new snapshot sharing everything that did not change, which
+    the back end then swaps in as a whole. Readers holding a snapshot therefore need no lock 
+    and see one consistent version across all keys. 
+    '''
+    def __init__(self, version=0, documents=None):
+        self.version = version
+        if documents is None:
+            documents = {}
+        self.documents = documents
+
+    def getdocument(self, key):
+        try:
+            return self.documents[key]
+        except KeyError:
+            return {}
+
+    def getentity(self, key, entityname):
+        return self.getdocument(key)[entityname]
+
+    def withdocument(self, key, doc):
+        documents = dict(self.documents)
+        documents[key] = doc
+        return InfoSnapshot(self.version + 1, documents)
+
+    def withentity(self, key, entityname, entity):
+        doc = dict(self.getdocument(key))
+        doc[entityname] = entity
+        return self.withdocument(key, doc)
+
+    def withentities(self, key, changes):
+        '''
+        Applies dict of entityname -> entity, or None to remove it. 
+        '''
+        doc = dict(self.getdocument(key))
+        for (entityname, entity) in changes.items():
+            if entity is None:
+                doc.pop(entityname, None)
+            else:
+                doc[entityname] = entity
+        return self.withdocument(key, doc)
+
+    def withoutentity(self, key, entityname):
+        '''
+        Raises KeyError if entity does not exist. 
+        '''
+        doc = dict(self.getdocument(key))
+        doc.pop(entityname)
+        return self.withdocument(key, doc)
+
+
+class InfoLockManager(object):
+    '''
+    Hands out write locks per document key, and optionally per entity within a key, so
+    writes to unrelated keys do not wait on each other. 
+    
+    Without an entity name, or with entitylocks off, the returned lock is exclusive for the 
+    whole key. With entitylocks on, an entity lock holds its key lock in shared mode plus 
+    one of a fixed set of striped locks, so writers of different entities of one key can 
+    proceed together while document-level writers still exclude them all. 
+    '''
+    def __init__(self, entitylocks=False, stripes=64):
+        self.entitylocks = entitylocks
+        self.keylocks = {}
+        self.mutex = threading.Lock()
+        self.stripes = [ threading.Lock() for i in range(stripes) ]
+
+    def getlock(self, key, entityname=None):
+        self.mutex.acquire()
+        try:
+            try:
+                keylock = self.keylocks[key]
+            except KeyError:
+                keylock = InfoKeyLock()
+                self.keylocks[key] = keylock
+        finally:
+            self.mutex.release()
+        if entityname is None or not self.entitylocks:
+            return keylock
+        stripe = self.stripes[hash((key, entityname)) % len(self.stripes)]
+        return InfoEntityLock(keylock, stripe)
+
+class InfoKeyLock(object):
+    '''
+    Shared/exclusive lock for one document key. acquire()/release() take it exclusively. 
+    Waiting exclusive holders block new shared holders, so document writes are not starved. 
+    '''
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.shared = 0
+        self.exclusive = False
+        self.waiting = 0
+
     def acquire(self):
-        pass
-        
+        self.cond.acquire()
+        try:
+            self.waiting += 1
+            while self.exclusive or self.shared > 0:
+                self.cond.wait()
+            self.waiting -= 1
+            self.exclusive = True
+        finally:
+            self.cond.release()
+
     def release(self):
-        pass
-        
+        self.cond.acquire()
+        try:
+            self.exclusive = False
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
+    def acquire_shared(self):
+        self.cond.acquire()
+        try:
+            while self.exclusive or self.waiting > 0:
+                self.cond.wait()
+            self.shared += 1
+        finally:
+            self.cond.release()
+
+    def release_shared(self):
+        self.cond.acquire()
+        try:
+            self.shared -= 1
+            if self.shared == 0:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
+class InfoEntityLock(object):
+    '''
+    Lock for one entity: its key lock held shared, plus the entity's stripe lock. 
+    '''
+    def __init__(self, keylock, stripe):
+        self.keylock = keylock
+        self.stripe = stripe
+
+    def acquire(self):
+        self.keylock.acquire_shared()
+        self.stripe.acquire()
 
+    def release(self):
+        self.stripe.release()
+        self.keylock.release_shared()
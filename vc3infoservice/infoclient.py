@@ -9,11 +9,15 @@ __email__ = "jhover@bnl.gov"
 __status__ = "Production"
 
 import base64
+import collections
 import json
 import logging
 import logging.handlers
 import requests
+import socket
+import threading
 import urllib
+import urlparse
 import os
 import platform
 import sys
@@ -25,6 +29,10 @@ from random import choice
 from string import ascii_uppercase
 from optparse import OptionParser
 from ConfigParser import ConfigParser, NoOptionError
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from requests.packages.urllib3.util.retry import Retry
 
 import urllib3
 try:
@@ -39,7 +47,7 @@ except AttributeError:
     pass
 
 from vc3infoservice.core import InfoEntity  
-from vc3infoservice.core import InfoConnectionFailure, InfoMissingPairingException, InfoEntityUpdateMissingException, InfoEntityMissingException, InfoEntityExistsException
+from vc3infoservice.core import InfoConnectionFailure, InfoMissingPairingException, InfoEntityUpdateMissingException, InfoEntityMissingException, InfoEntityExistsException, InfoEntityVersionException
 
 
 TESTKEY='testkey'
@@ -57,7 +65,78 @@ TESTDOC='''{
 
 
 
+class InfoUnixConnection(HTTPConnection):
+    '''
+    HTTP connection over the unix domain socket at <path>. 
+    '''
+    def __init__(self, path, timeout=60):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+class InfoUnixConnectionPool(HTTPConnectionPool):
+
+    def __init__(self, path, timeout=60):
+        HTTPConnectionPool.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+        self.timeout = timeout
+
+    def _new_conn(self):
+        return InfoUnixConnection(self.path, self.timeout)
+
+
+class InfoUnixAdapter(HTTPAdapter):
+    '''
+    Transport adapter for http+unix://<quoted socket path>/<path> URLs, keeping one connection
+    pool per socket. 
+    '''
+    def __init__(self, timeout=60, max_retries=0):
+        HTTPAdapter.__init__(self, max_retries=max_retries)
+        self.timeout = timeout
+        self.unixpools = {}
+        self.unixlock = threading.Lock()
+
+    def get_connection(self, url, proxies=None):
+        path = urllib.unquote(urlparse.urlparse(url).netloc)
+        self.unixlock.acquire()
+        try:
+            try:
+                return self.unixpools[path]
+            except KeyError:
+                pool = InfoUnixConnectionPool(path, self.timeout)
+                self.unixpools[path] = pool
+                return pool
+        finally:
+            self.unixlock.release()
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        self.unixlock.acquire()
+        try:
+            for pool in self.unixpools.values():
+                pool.close()
+            self.unixpools = {}
+        finally:
+            self.unixlock.release()
+        HTTPAdapter.close(self)
+
+
 class InfoClient(object):
+
+    # JSON payloads are sent as request body, which has no size limit, unlike the query string. 
+    JSONHEADERS = {'Content-Type' : 'application/json'}
+    # times a request answered 503 (service overloaded) is retried, after its Retry-After. 
+    OVERLOADRETRIES = 3
+    # characters of response text kept for conditional GETs. 
+    RESPONSECACHESIZE = 16 * 1024 * 1024
     
     def __init__(self, config):
         self.log = logging.getLogger()
@@ -77,6 +156,28 @@ class InfoClient(object):
         self.httpport  = int(config.get('netcomm','httpport'))
         self.httpsport = int(config.get('netcomm','httpsport'))
         self.infohost  = config.get('netcomm','infohost')
+
+        # Co-located clients may talk plain HTTP over the service's unix socket instead.
+        self.infosocket = None
+        try:
+            self.infosocket = os.path.expanduser(config.get('netcomm', 'infosocket'))
+        except NoOptionError:
+            pass
+
+        self.session = requests.Session()
+        retries = self._overloadretries()
+        if self.infosocket:
+            self.infourl = "http+unix://%s" % urllib.quote(self.infosocket, safe='')
+            self.session.mount('http+unix://', InfoUnixAdapter(max_retries=retries))
+        else:
+            self.infourl = "https://%s:%s" % (self.infohost, self.httpsport)
+            self.session.mount('https://', HTTPAdapter(max_retries=retries))
+
+        # Last response ETag and text per GET URL, for conditional GETs, least recently used 
+        # first. (requests sends Accept-Encoding: gzip, deflate and decodes compressed responses.)
+        self.responses = collections.OrderedDict()
+        self.responsesize = 0
+        self.responseslock = threading.Lock()
       
         self.log.debug("Client initialized.")
 
@@ -90,8 +191,7 @@ class InfoClient(object):
         
         '''    
         ename = edict.keys()[0]
-        u = "https://%s:%s/info?key=%s&entityname=%s" % (self.infohost, 
-                                                         self.httpsport,
+        u = "%s/info?key=%s&entityname=%s" % (self.infourl, 
                                                          key,
                                                          ename
                                                          )
@@ -99,7 +199,7 @@ class InfoClient(object):
         jdoc = json.dumps(edict)
         self.log.debug("Entity converted to JSON: '%s'" % jdoc)
         try:
-            r = requests.post(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params={'data' : jdoc})
+            r = self.session.post(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), data=jdoc, headers=InfoClient.JSONHEADERS)
             self.log.debug(r.status_code)
             if r.status_code == 405 :
                 raise InfoEntityExistsException("Attempted to store an Entity that already exists. Name: %s" % ename)
@@ -107,39 +207,37 @@ class InfoClient(object):
             self.log.error('Connection failure. %s' % ce)
             raise InfoConnectionFailure(str(ce))
 
-    def _getentitydict(self, key, entityname):
+    def _getentitydict(self, key, entityname, fields=None):
         '''
-        Get and return dictionary string for entity <entityname> in key <key>.
+        Get and return (dictionary, ETag) for entity <entityname> in key <key>.
+        Only attributes in list <fields>, if given. 
         '''
-        u = "https://%s:%s/info?key=%s&entityname=%s" % (self.infohost, 
-                            self.httpsport,
-                            key,
-                            entityname
-                            )
+        u = self._entityurl(key, entityname, fields)
         try:
-            r = requests.get(u, verify=self.chainfile, cert=(self.certfile, 
-                                                             self.keyfile))
+            r = self._conditionalget(u)
             if r.status_code == 405 :
                 raise InfoEntityMissingException("Attempted to get an Entity that doesn't exist. Name: %s" % entityname)
-            out = self.stripquotes(r.text)
+            out = self.stripquotes(self._responsetext(u, r))
             parsed = json.loads(out)
             #pretty = json.dumps(parsed, indent=4, sort_keys=True)
-            return parsed
+            return (parsed, self._responseetag(r))
         except requests.exceptions.ConnectionError, ce:
             self.log.error('Connection failure. %s' % ce)
             raise InfoConnectionFailure(str(ce))
 
 
-    def listentities(self, klass):
+    def listentities(self, klass, fields=None, where=None):
         '''
         Return list of instance objects for all <entityclass> entities in infoservice. 
-        
+        If list <fields> is given, objects only have those attributes (and name) set, 
+        the rest are None. If dict <where> is given, only returns entities matching it, 
+        e.g. {'state' : 'new'}. A list attribute matches if it contains the value. 
         '''
         #m = sys.modules[__name__] 
         #klass = getattr(m, entityclass)
         infokey = klass.infokey
         self.log.debug("Listing class %s with infokey %s " % (klass.__name__, infokey))     
-        docobj = self.getdocumentdict(infokey)
+        docobj = self.getdocumentdict(infokey, self._entityfields(klass, fields), where)
         self.log.debug("Got document object: %s " % docobj)
         olist = []
         try:
@@ -147,7 +245,7 @@ class InfoClient(object):
                     self.log.debug("Getting objectname %s" % oname)
                     #s = "{ '%s' : %s }" % (oname, docobj[infokey][oname] )
                     ed = docobj[oname]
-                    eo = klass.objectFromDict(ed)
+                    eo = klass.objectFromDict(ed, fields is not None)
                     self.log.debug("Appending eo %s" % eo)
                     olist.append(eo)
         except KeyError, e:
@@ -157,60 +255,113 @@ class InfoClient(object):
         return olist
 
 
-    def getentity(self, entityclass, entityname):
+    def iterentities(self, klass, fields=None, where=None, pagesize=500):
+        '''
+        Generator variant of listentities(). Gets entities a page of <pagesize> at a time, in 
+        entity name order, so only one page is held in memory. Entities written while 
+        iterating may or may not be seen, but none is returned twice. 
+        '''
+        infokey = klass.infokey
+        fields = self._entityfields(klass, fields)
+        after = None
+        while True:
+            page = self._getdocumentpage(infokey, pagesize, after, fields, where)
+            if page is None:
+                break
+            for oname in sorted(page['entities'].keys()):
+                self.log.debug("Getting objectname %s" % oname)
+                yield klass.objectFromDict(page['entities'][oname], fields is not None)
+            after = page['next']
+            if after is None:
+                break
+
+    def _getdocumentpage(self, key, limit, after=None, fields=None, where=None):
+        '''
+        Get one page of document <key>: {"entities": {...}, "next": <after for next page>}.
+        None if the service has no document <key>.
+        '''
+        params = { 'key' : key, 'limit' : limit }
+        if after is not None:
+            params['after'] = after
+        if fields is not None:
+            params['fields'] = ','.join(fields)
+        if where is not None:
+            params['where'] = json.dumps(where, sort_keys=True)
+        u = "%s/info" % self.infourl
+        try:
+            r = self.session.get(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params=params)
+            self.log.debug(r.status_code)
+            if r.status_code == 404:
+                return None
+            if r.status_code != 200:
+                raise InfoConnectionFailure("Page of %s refused (%d): %s" % (key, r.status_code, r.text))
+            return json.loads(r.text)
+        except requests.exceptions.ConnectionError, ce:
+            self.log.error('Connection failure. %s' % ce)
+            raise InfoConnectionFailure(str(ce))
+
+    def getentity(self, entityclass, entityname, fields=None):
         '''
         Returns a valid instance object of <entityclass> from the infoservice. 
-        
+        If list <fields> is given, only those attributes (and name) are set, the rest are None.
         '''
         klass = entityclass
         infokey = klass.infokey
+        fields = self._entityfields(klass, fields)
         self.log.debug("Getting %s entity %s with infokey %s " % (entityclass, entityname, infokey))     
-        eobj = self._getentitydict(infokey, entityname)
+        (eobj, etag) = self._getentitydict(infokey, entityname, fields)
         self.log.debug("Type of eobj is %s" % type(eobj))
         self.log.debug("Got entity object: %s " % eobj)
-        eo = klass.objectFromDict(eobj)
+        eo = klass.objectFromDict(eobj, fields is not None)
+        if etag is not None:
+            eo.infoetag = etag
         return eo
 
-    def _mergeentitydict(self, key, edict):
+    def _mergeentitydict(self, key, edict, etag=None):
         '''
         Take entity dict and update existing entity in infoservice after conversion to JSON. 
+        If etag is given, only updates if the entity is still at that version.
+        Returns ETag of the updated entity. 
         '''
         ename = edict.keys()[0]
-        u = "https://%s:%s/info?key=%s&entityname=%s" % (self.infohost, 
-                                                         self.httpsport,
-                                                         key,
-                                                         ename
-                                                         )
+        u = self._entityurl(key, ename)
         self.log.debug("Trying to merge dict %s at %s" % (edict, u))
         jdoc = json.dumps(edict)
         self.log.debug("Entity converted to JSON: '%s'" % jdoc)
+        headers = dict(InfoClient.JSONHEADERS)
+        if etag is not None:
+            headers['If-Match'] = etag
         try:
-            r = requests.put(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params={'data' : jdoc})
+            r = self.session.put(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), data=jdoc, headers=headers)
             self.log.debug(r.status_code)            
             if r.status_code == 405 :
                 raise InfoEntityUpdateMissingException("Attempted to update an Entity that doesn't exist. Name: %s" % ename)
- 
+            if r.status_code == 412 :
+                raise InfoEntityVersionException("Entity changed since version %s. Name: %s" % (etag, ename))
+            return r.headers.get('ETag')
         except requests.exceptions.ConnectionError, ce:
             self.log.error('Connection failure. %s' % ce)
             raise InfoConnectionFailure(str(ce))
 
     
-    def deleteentity(self, entityclass, entityname):
+    def deleteentity(self, entityclass, entityname, etag=None):
         '''
         deletes given entityname from key
+        If etag is given, only deletes if the entity is still at that version.
         '''
         klass = entityclass
         key = klass.infokey
-        u = "https://%s:%s/info?key=%s&entityname=%s" % (self.infohost, 
-                                                         self.httpsport,
-                                                         key,
-                                                         entityname
-                                                         )
+        u = self._entityurl(key, entityname)
+        headers = {}
+        if etag is not None:
+            headers['If-Match'] = etag
         try:
-            r = requests.delete(u, verify=self.chainfile, cert=(self.certfile, self.keyfile))
+            r = self.session.delete(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), headers=headers)
             self.log.debug(r.status_code)            
             if r.status_code == 405 :
                 raise InfoEntityMissingException("Attempted to delete an Entity that doesn't exist. Name: %s" % entityname)
+            if r.status_code == 412 :
+                raise InfoEntityVersionException("Entity changed since version %s. Name: %s" % (etag, entityname))
  
         except requests.exceptions.ConnectionError, ce:
             self.log.error('Connection failure. %s' % ce)
@@ -223,18 +374,22 @@ class InfoClient(object):
 #                     Category document-oriented methods
 ################################################################################
         
-    def getdocument(self, key):
+    def getdocument(self, key, fields=None, where=None):
         '''
         Get and return JSON string for document with key <key> from infoservice. 
-                
+        Only attributes in list <fields> of each entity, if given. Only entities matching 
+        dict <where>, if given (see listentities()). 
         '''
-        u = "https://%s:%s/info?key=%s" % (self.infohost, 
-                            self.httpsport,
+        u = "%s/info?key=%s" % (self.infourl, 
                             key
                             )
+        if fields is not None:
+            u += "&fields=%s" % urllib.quote(','.join(fields))
+        if where is not None:
+            u += "&where=%s" % urllib.quote(json.dumps(where, sort_keys=True))
         try:
-            r = requests.get(u, verify=self.chainfile, cert=(self.certfile, self.keyfile))
-            return r.text
+            r = self._conditionalget(u)
+            return self._responsetext(u, r)
         except requests.exceptions.ConnectionError, ce:
             self.log.error('Connection failure. %s' % ce)
             raise InfoConnectionFailure(str(ce))
@@ -245,24 +400,23 @@ class InfoClient(object):
         Store JSON string <doc> in infoservice under key <key>. 
         
         '''
-        u = "https://%s:%s/info?key=%s" % (self.infohost, 
-                            self.httpsport,
+        u = "%s/info?key=%s" % (self.infourl, 
                             key
                             )
         self.log.debug("Trying to store document %s at %s" % (doc, u))
         try:
-            r = requests.post(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params={'data' : doc})
+            r = self.session.post(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), data=doc, headers=InfoClient.JSONHEADERS)
             self.log.debug(r.status_code)
         except requests.exceptions.ConnectionError, ce:
             self.log.error('Connection failure. %s' % ce)
             raise InfoConnectionFailure(str(ce))
 
 
-    def getdocumentdict(self, key):
+    def getdocumentdict(self, key, fields=None, where=None):
         '''
         Get JSON doc and convert to Python and return. 
         '''
-        text = self.getdocument(key)
+        text = self.getdocument(key, fields, where)
         out = self.stripquotes(text)
         parsed = json.loads(out)
         pretty = json.dumps(parsed, indent=4, sort_keys=True)
@@ -285,13 +439,12 @@ class InfoClient(object):
 
     def mergedocument(self, key, doc):
                 
-        u = "https://%s:%s/info?key=%s" % (self.infohost, 
-                            self.httpsport,
+        u = "%s/info?key=%s" % (self.infourl, 
                             key
                             )
         self.log.debug("Trying to merge document %s at %s" % (doc, u))
         try:
-            r = requests.put(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params={'data' : doc})
+            r = self.session.put(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), data=doc, headers=InfoClient.JSONHEADERS)
             self.log.debug(r.status_code)
         
         except requests.exceptions.ConnectionError, ce:
@@ -299,48 +452,146 @@ class InfoClient(object):
             raise InfoConnectionFailure(str(ce))
 
     def getbranch(self, *keys):
-        doc = self.getdocument(key = keys[0])
-        if not doc:
-            return None
-        ds = json.loads(doc)
-        good_keys = []
-        for k in keys:
-            if k in ds:
-                ds = ds[k]
-            else:
-                raise Exception('Successful keys: ' + str(good_keys))
-        return ds
+        '''
+        Returns Python value at path keys[0] -> keys[1] -> ... in the infoservice. 
+        '''
+        if len(keys) == 1:
+            doc = self.getdocument(key = keys[0])
+            if not doc:
+                return None
+            return json.loads(doc)
+        try:
+            return self.getsubtree(list(keys))
+        except InfoEntityMissingException:
+            raise Exception('No such path: ' + str(keys))
     
     def getsubtree(self, path):
-        pass
+        '''
+        Returns Python value at path, given as dotted string "<key>.<entityname>.<attr>..." or
+        as list [<key>, <entityname>, <attr>, ...]. List items are addressed by index. 
+        Only the value is transferred, not the whole document. 
+        '''
+        u = self._pathurl(path)
+        self.log.debug("Trying to get subtree at %s" % u)
+        try:
+            r = self._conditionalget(u)
+            self.log.debug(r.status_code)
+            if r.status_code == 405 :
+                raise InfoEntityMissingException("Attempted to get a path that doesn't exist: %s" % (path,))
+            return json.loads(self._responsetext(u, r))
+        except requests.exceptions.ConnectionError, ce:
+            self.log.error('Connection failure. %s' % ce)
+            raise InfoConnectionFailure(str(ce))
+
+    def mergesubtree(self, path, value):
+        '''
+        Merges Python value into the value at path (as for getsubtree()). Into a dictionary, the 
+        given attributes replace existing ones. Any other value is replaced. 
+        '''
+        u = self._pathurl(path)
+        jdoc = json.dumps(value)
+        self.log.debug("Trying to merge %s at %s" % (jdoc, u))
+        try:
+            r = self.session.put(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), data=jdoc, headers=InfoClient.JSONHEADERS)
+            self.log.debug(r.status_code)
+            if r.status_code == 405 :
+                raise InfoEntityUpdateMissingException("Attempted to update a path that doesn't exist: %s" % (path,))
+        except requests.exceptions.ConnectionError, ce:
+            self.log.error('Connection failure. %s' % ce)
+            raise InfoConnectionFailure(str(ce))
   
     def deletesubtree(self, path):
         '''
-        Delete the leaf given by path.
+        Delete the leaf given by path (as for getsubtree()). 
         '''
+        u = self._pathurl(path)
+        self.log.debug("Trying to delete subtree at %s" % u)
         try:
-            keys = path.split('.')
-            key  = keys[0]
-        
-            u = "https://%s:%s/info?key=%s" % (self.infohost, 
-                                self.httpsport,
-                                key
-                                )
-            self.log.debug("Trying to delete document at %s" % (path,))
-
-            r = requests.delete(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params={'name' : path})
+            r = self.session.delete(u, verify=self.chainfile, cert=(self.certfile, self.keyfile))
             self.log.debug(r.status_code)
+            if r.status_code == 405 :
+                raise InfoEntityMissingException("Attempted to delete a path that doesn't exist: %s" % (path,))
+            return r.text
+        except requests.exceptions.ConnectionError, ce:
+            self.log.error('Connection failure. %s' % ce)
+            raise InfoConnectionFailure(str(ce))
+
+    def _pathurl(self, path):
+        '''
+        URL of path [<key>, <entityname>, <attr>, ...] or "<key>.<entityname>.<attr>...". 
+        Entity names containing dots need the list form. 
+        '''
+        if isinstance(path, basestring):
+            path = path.split('.', 2)
+        if len(path) < 2:
+            raise IndexError('Path should contain at least a key and an entity name')
+        params = { 'key' : path[0], 'entityname' : path[1] }
+        if len(path) > 2:
+            params['path'] = '.'.join([ str(name) for name in path[2:] ])
+        return "%s/info?%s" % (self.infourl, urllib.urlencode(sorted(params.items())))
+
+
+    def batch(self, ops):
+        '''
+        Applies list of entity operations in one request, and returns list of results. E.g.
+
+          ops = [ {"op": "create", "key": "user", "entityname": "jhover", "entity": {...}},
+                  {"op": "merge", "key": "project", "entityname": "atlas", "entity": {...}},
+                  {"op": "delete", "key": "user", "entityname": "angus"},
+                  someentity.makeBatchOp() ]
+          
+          results = [ {"status": 200, "message": "OK", "etag": <etag>}, ... ]
         
-        except IndexError, e:
-            self.log.error('Path should contain at least one key')
-            raise e
+        Per-op status is as for the single-entity requests (405 for an existing entity on 
+        create, a missing one on merge and delete). Failed ops do not undo the others.
+        '''
+        u = "%s/batch" % self.infourl
+        jdoc = json.dumps(ops)
+        self.log.debug("Sending batch of %d ops to %s" % (len(ops), u))
+        try:
+            r = self.session.post(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), data=jdoc, headers=InfoClient.JSONHEADERS)
+            self.log.debug(r.status_code)
+            if r.status_code != 200:
+                raise ValueError("Batch refused: %s" % r.text)
+            return json.loads(r.text)
+        except requests.exceptions.ConnectionError, ce:
+            self.log.error('Connection failure. %s' % ce)
+            raise InfoConnectionFailure(str(ce))
+
+    def watch(self, key, since=None, entityname=None, timeout=None):
+        '''
+        Waits until document <key> (entity <entityname> only, if given) changes past version
+        <since>, or timeout seconds pass, and returns dict:
+
+          {"key": "user", "etag": <etag>, "changed": true, "entities": ["jhover"], "resync": false}
+
+        Pass the returned etag as <since> to the next call. Re-read the changed entities, or
+        the whole document if resync is true. Without since, waits for the next change.
+        '''
+        u = "%s/watch" % self.infourl
+        params = {'key' : key}
+        if since is not None:
+            params['since'] = since
+        if entityname is not None:
+            params['entityname'] = entityname
+        if timeout is not None:
+            params['timeout'] = timeout
+        try:
+            while True:
+                r = self.session.get(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), params=params)
+                self.log.debug(r.status_code)
+                if r.status_code != 503:
+                    break
+                # service has too many watchers.
+                time.sleep(float(r.headers.get('Retry-After', 1)))
+            return json.loads(r.text)
         except requests.exceptions.ConnectionError, ce:
             self.log.error('Connection failure. %s' % ce)
             raise InfoConnectionFailure(str(ce))
 
 
 ##################################################################################
-#                             Infrastructural methods 
+#                             Infrastructural methods
 ##################################################################################
 
     def requestPairing(self, cnsubject):
@@ -357,25 +608,31 @@ class InfoClient(object):
                      pairingcode=pairingcode
                      )
         self.log.debug("Made pairing request: %s" % po)
+        # a new entity, so created rather than merged. 
+        po.storenew = True
         po.store(self)
         self.log.debug("Stored in /info/pairing..")
         return pairingcode
 
-    def getPairing(self, pairingcode):
+    def getPairing(self, pairingcode, wait=None):
         '''
             Special call because it sends pairing code as data, along with URL
         
             :param str pairingcode    Code to be paired with. 
+            :param float wait         Seconds the service may wait for the cert to be made.
             :return
             :rtype (str, str)         Cert and key
         '''
-        u = "https://%s:%s/info?key=pairing&pairingcode=%s" % (self.infohost, 
-                            self.httpsport,
+        u = "%s/info?key=pairing&pairingcode=%s" % (self.infourl, 
                             pairingcode
                             )
+        if wait is not None:
+            u += "&wait=%s" % wait
         self.log.debug("Attempting to get pairing via URL %s" % u)
         try:
-            r = requests.get(u, verify=self.chainfile)     
+            r = self.session.get(u, verify=self.chainfile)     
+            if r.status_code == 404:
+                raise InfoMissingPairingException("Missing pairing.")
             pe = json.loads(r.text)
             ecert = pe['cert']
             ekey = pe['key']
@@ -404,6 +661,91 @@ class InfoClient(object):
         rs = s.replace("'","")
         return rs
 
+    def _entityurl(self, key, entityname, fields=None):
+        u = "%s/info?key=%s&entityname=%s" % (self.infourl, 
+                                                         key,
+                                                         entityname
+                                                         )
+        if fields is not None:
+            u += "&fields=%s" % urllib.quote(','.join(fields))
+        return u
+
+    def _entityfields(self, klass, fields):
+        '''
+        Fields to request for partial objects of klass: fields plus those making up its name. 
+        '''
+        if fields is None:
+            return None
+        return sorted(set(fields) | set(klass.nameattributes) | set(['name']))
+
+    def _overloadretries(self):
+        '''
+        Retry policy for 503 responses only. The service sends them before handling a request, 
+        so any method can be retried. 
+        '''
+        args = { 'total' : InfoClient.OVERLOADRETRIES, 
+                 'connect' : 0,
+                 'read' : 0, 
+                 'status' : InfoClient.OVERLOADRETRIES, 
+                 'status_forcelist' : [ 503 ], 
+                 'respect_retry_after_header' : True, 
+                 'raise_on_status' : False }
+        try:
+            return Retry(allowed_methods=False, **args)
+        except TypeError:
+            # urllib3 before 1.26
+            return Retry(method_whitelist=False, **args)
+
+    def _conditionalget(self, u):
+        '''
+        GET which sends the ETag of the last response for this URL, if any. 
+        '''
+        headers = {}
+        self.responseslock.acquire()
+        try:
+            cached = self.responses.pop(u, None)
+            if cached is not None:
+                # most recently used. 
+                self.responses[u] = cached
+                headers['If-None-Match'] = cached[0]
+        finally:
+            self.responseslock.release()
+        r = self.session.get(u, verify=self.chainfile, cert=(self.certfile, self.keyfile), headers=headers)
+        # what a 304 refers to, even if evicted or replaced by another thread meanwhile. 
+        r.infocached = cached
+        return r
+
+    def _responsetext(self, u, r):
+        '''
+        Returns text of response r to GET of u, reusing the previous text if not modified.  
+        '''
+        if r.status_code == 304 and r.infocached is not None:
+            self.log.debug("Not modified: %s" % u)
+            return r.infocached[1]
+        etag = r.headers.get('ETag')
+        self.responseslock.acquire()
+        try:
+            cached = self.responses.pop(u, None)
+            if cached is not None:
+                self.responsesize -= len(cached[1])
+            if etag is not None and r.status_code == 200 and len(r.text) <= InfoClient.RESPONSECACHESIZE:
+                self.responses[u] = (etag, r.text)
+                self.responsesize += len(r.text)
+                while self.responsesize > InfoClient.RESPONSECACHESIZE:
+                    (oldu, (oldetag, oldtext)) = self.responses.popitem(last=False)
+                    self.responsesize -= len(oldtext)
+        finally:
+            self.responseslock.release()
+        return r.text
+
+    def _responseetag(self, r):
+        '''
+        ETag of the text _responsetext() returned for response r.  
+        '''
+        if r.status_code == 304 and r.infocached is not None:
+            return r.infocached[0]
+        return r.headers.get('ETag')
+
     def encode(self, string):
         return base64.b64encode(string)
     
@@ -543,6 +885,14 @@ John Hover <jhover@bnl.gov>
                           metavar="PAIRINGCODE",
                           help="Retrieve cert/key pair for supplied pairing code."
                           )
+
+        parser.add_option("--pairingwait",
+                          dest = "pairingwait",
+                          action = "store",
+                          type = "float",
+                          metavar="SECONDS",
+                          help="With --getpairing, wait up to SECONDS for the cert/key pair to be made."
+                          )
                         
         (self.options, self.args) = parser.parse_args()
         self.options.confFiles = self.options.confFiles.split(',')
@@ -644,7 +994,7 @@ John Hover <jhover@bnl.gov>
             try:
                 #out = self.ic.getPairing(self.options.pairingcode)
                 #print("out is %s" % out)
-                (cert, key) = self.ic.getPairing(self.options.pairingcode)
+                (cert, key) = self.ic.getPairing(self.options.pairingcode, self.options.pairingwait)
                 print("%s" % cert)
                 print("")
                 print("%s" % key)
@@ -9,25 +9,35 @@ __email__ = "jhover@bnl.gov"
 __status__ = "Production"
 
 
+import bisect
 import cherrypy
+import collections
+import errno
 import logging
 import logging.handlers
 import os
 import platform
 import pwd
+import Queue
 import random
 import json
+import signal
 import string
 import socket
 import sys
 import threading
 import time
 import traceback
+import zlib
 
+from cherrypy._cpwsgi_server import CPWSGIServer
+from cherrypy.process.servers import ServerAdapter
+from multiprocessing.connection import Listener, Client
 from optparse import OptionParser
-from ConfigParser import ConfigParser
+from ConfigParser import ConfigParser, NoOptionError, NoSectionError
 
 from vc3infoservice.core  import InfoEntityExistsException, InfoEntityMissingException
+from vc3infoservice.core  import InfoPersistencePlugin, InfoSnapshot
 
 # Since script is in package "vc3" we can know what to add to path for 
 # running directly during development
@@ -49,23 +59,90 @@ class InfoHandler(object):
     
     returned entities are in the form of unindexed entity JSON dictionaries , e.g. 
         '{ "name" : "namevalue", "key1" : "val1" }'
+
+    Documents and entities obtained from the plugin may be shared with concurrent readers, 
+    so they are never modified in place: writes merge into copies and store those. 
      
     '''
+    # optimistic entity updates losing this many races fall back to updating under the lock.
+    CASRETRIES = 3
+    # bytes per chunk of streamed documents.
+    STREAMCHUNK = 64 * 1024
+    # key of pairing entries, always indexed by pairingcode.
+    PAIRINGKEY = 'pairing'
+    # response content codings we can produce, with their zlib wbits. 
+    ENCODINGS = { 'gzip' : 16 + zlib.MAX_WBITS, 
+                  'deflate' : zlib.MAX_WBITS }
+
     def __init__(self, config):
         self.log = logging.getLogger()
         self.log.debug("Initializing Info Handler...")
         self.config = config
+        self.metrics = InfoMetrics()
+        self.admission = InfoAdmission(config)
         
+        try:
+            cachemaxbytes = config.getint('cache', 'maxbytes')
+        except (NoOptionError, NoSectionError):
+            cachemaxbytes = 256 * 1024 * 1024
+        self.cache = InfoResponseCache(cachemaxbytes)
+        try:
+            self.compress = config.getboolean('compression', 'enabled')
+        except (NoOptionError, NoSectionError):
+            self.compress = True
+        try:
+            self.compressminbytes = config.getint('compression', 'minbytes')
+        except (NoOptionError, NoSectionError):
+            self.compressminbytes = 4096
+        try:
+            self.compresslevel = config.getint('compression', 'level')
+        except (NoOptionError, NoSectionError):
+            self.compresslevel = 6
+        self.versions = InfoVersionTable()
+        self.nameslock = threading.Lock()
+        self.sortednames = {}
+        try:
+            maxchanges = config.getint('watch', 'maxchanges')
+        except (NoOptionError, NoSectionError):
+            maxchanges = 1024
+        try:
+            self.maxwatchers = config.getint('watch', 'maxwatchers')
+        except (NoOptionError, NoSectionError):
+            self.maxwatchers = 20
+        try:
+            self.maxwatchtimeout = config.getfloat('watch', 'maxtimeout')
+        except (NoOptionError, NoSectionError):
+            self.maxwatchtimeout = 60.0
+        self.changes = InfoChangeFeed(maxchanges)
+        indexes = { InfoHandler.PAIRINGKEY : ['pairingcode'] }
+        if config.has_section('indexes'):
+            for key in config.options('indexes'):
+                if key in config.defaults():
+                    continue
+                attributes = [ a.strip() for a in config.get('indexes', key).split(',') if a.strip() ]
+                indexes[key] = list(set(indexes.get(key, []) + attributes))
+        self.indexes = InfoIndexTable()
+        # InfoWriter passing writes on to prefork workers, if any. 
+        self.publisher = None
         # Get persistence plugin
-        pluginname = config.get('persistence','plugin')
+        self.persist = InfoTimedPersistence(self.makeplugin(), self.metrics)
+        for (key, attributes) in indexes.items():
+            self.addindex(key, attributes)
+            self.log.debug("Indexed key %s by %s" % (key, attributes))
+        self.log.debug("Done initializing InfoHandler")
+
+    def makeplugin(self):
+        pluginname = self.config.get('persistence','plugin')
         psect = "plugin-%s" % pluginname.lower()
         self.log.debug("Creating persistence plugin...")
-        self.persist = pm.getplugin(parent=self, 
-                                    paths=['vc3infoservice', 'plugins', 'persist'], 
-                                    name=pluginname, 
-                                    config=self.config, 
-                                    section=psect)
-        self.log.debug("Done initializing InfoHandler")
+        return pm.getplugin(parent=self, 
+                            paths=['vc3infoservice', 'plugins', 'persist'], 
+                            name=pluginname, 
+                            config=self.config, 
+                            section=psect)
+
+    def addindex(self, key, attributes):
+        self.indexes.addindex(key, attributes, self.persist.getsnapshot().getdocument(key))
 
 ################################################################################
 #                     Entity-oriented methods
@@ -84,51 +161,57 @@ class InfoHandler(object):
                    }
         '''
         self.log.debug("input JSON doc to merge is %s" % edoc)
-        entitydict = json.loads(edoc)
-        self.persist.lock.acquire()
+        entitydict = self._loads(edoc)
+        if not isinstance(entitydict, dict) or entityname not in entitydict:
+            cherrypy.response.status = 400
+            return "Entity document does not contain Entity. Name: %s. " % entityname
+        newentity = entitydict[entityname]
+        lock = self.persist.locks.getlock(key, entityname)
+        self._acquire(lock)
         try:
-            currentdoc = self.persist.getdocument(key)
             try:
-                existingentity = currentdoc[entityname]
+                existingentity = self.persist.getentity(key, entityname)
                 cherrypy.response.status = 405
                 return "Attempt to create (POST) already-existing Entity. Name: %s. " % entityname
             except KeyError:
                 self.log.debug("No existing entity %s. As expected..." % entityname)
                 pass
             
-            self.log.debug("Merging entity with existing document.")
-            newdoc = self.merge( entitydict, currentdoc)
-            self.persist.storedocument(key, newdoc)
+            self.persist.storeentity(key, entityname, newentity)
+            self._written(key, entityname)
             self.log.debug("Successfully stored entity.")            
         finally:
-            self.persist.lock.release()        
+            lock.release()
+        self.persist.sync()
 
-    def mergeentity(self, key, entityname, edoc):
+    def mergeentity(self, key, entityname, edoc, ifmatch=None):
         '''
         merges contents of (update-only) JSON doc string by entity level. 
         Within entity, uses merge that replaces attributes with new values.
+        If ifmatch (If-Match header value) is given, only updates an unchanged entity. 
         '''
         self.log.debug("input entity doc to merge is %s" % edoc)       
         # e.g. {"SPT": {"allocations": ["lincolnb.uchicago-midway"]}}
         self.log.debug("input JSON doc to merge is type %s" % type(edoc))
-        entitydict = json.loads(edoc)
-        self.persist.lock.acquire()
+        entitydict = self._loads(edoc)
+        if not isinstance(entitydict, dict) or entityname not in entitydict:
+            cherrypy.response.status = 400
+            return "Entity document does not contain Entity. Name: %s. " % entityname
+        newentity = entitydict[entityname]
+
+        def change(existingentity):
+            # merge into a copy, never into the stored object itself.
+            mergedentity = dict(existingentity)
+            self.entitymerge(newentity, mergedentity)
+            return mergedentity
+
         try:
-            currentdoc = self.persist.getdocument(key)
-            existingentity = currentdoc[entityname]
-            newentity = entitydict[entityname]
-            #self.log.debug("Existing entity: %s" % existingentity)
-            #self.log.debug("New entity:" % newentity)
-            #self.log.debug("Merging newentity with existing entity.")
-            self.entitymerge(newentity, existingentity)
-            #self.log.debug("Resulting existing: %s" % existingentity)
-            self.persist.storedocument(key, currentdoc)
-            self.log.debug("Successfully stored entity.")            
+            msg = self._casentity(key, entityname, change, ifmatch)
         except KeyError:
             cherrypy.response.status = 405
             return "Attempt to update (PUT) non-existent Entity. Name: %s. " % entityname
-        finally:
-            self.persist.lock.release()        
+        self.persist.sync()
+        return msg
 
     def entitymerge(self, src, dest):
             ''' 
@@ -146,47 +229,329 @@ class InfoHandler(object):
              u'blueprints': []}
              
             '''
-            self.log.debug("Handling merging %s into %s " % (src, dest))
+            self.log.debug("Handling merging %s into %s", src, dest)
+            start = time.time()
             for attributename in src.keys():
                 dest[attributename] = src[attributename]
+            self.metrics.observe('merge.entity', time.time() - start)
 
-    def getentity(self, key, entityname):
+    def getentity(self, key, entityname, encodings=None, fields=None):
         '''
         Gets JSON representation of entity.
         
         { 'name' : <entityname>',
           'key1'  : '<val1>'
         }        
+        
+        Only attributes in list fields, if given. Compressed if large enough and one of 
+        encodings (acceptable content codings, preferred first) can be used. 
         '''
-        currentdoc = self.persist.getdocument(key)
-        self.log.debug("Current doc for %s is %s" % (key, currentdoc))
+        variant = self._fieldsvariant(fields)
+        # taken before reading, so a write landing in between can only make the 
+        # result newer than its version, never older.
+        version = self.versions.getversion(key, entityname)
+        je = self.cache.get(key, entityname, version, variant)
+        if je is not None:
+            return self._encode(key, entityname, version, je, encodings, variant)
         try:
-            ed = currentdoc[entityname]
-            je = json.dumps(ed)
+            ed = self.persist.getsnapshot().getentity(key, entityname)
+            je = self._dumps(self._project(ed, fields))
             self.log.debug("JSON entity is %s" % str(je))
-            return je
+            self.cache.put(key, entityname, je, version, variant)
+            return self._encode(key, entityname, version, je, encodings, variant)
         except KeyError:
             cherrypy.response.status = 405
             return "Attempt to GET non-existent Entity. Name: %s. " % entityname
             #raise InfoEntityMissingException("Attempt to update or get a non-existent Entity.")
 
 
-    def deleteentity(self, key, entityname):
+    def deleteentity(self, key, entityname, ifmatch=None):
         '''
         deletes relevant entity, if it exists. 
+        If ifmatch (If-Match header value) is given, only deletes an unchanged entity. 
         '''
-        self.persist.lock.acquire()
+        self.log.debug("Deleting entity %s in key %s" % (entityname, key))
         try:
-            doc = self.persist.getdocument(key)
-            self.log.debug("Deleting entity %s in key %s" % (entityname, key))
-            doc.pop(entityname)
-            self.persist.storedocument(key, doc)
-            self.log.debug("Successfully stored.")            
+            msg = self._casentity(key, entityname, lambda existingentity: None, ifmatch)
         except KeyError:
             cherrypy.response.status = 405
             return "Entity %s not found, so can't delete it." % entityname
+        self.persist.sync()
+        return msg
+
+    def _casentity(self, key, entityname, change, ifmatch=None):
+        '''
+        Replaces entity with change(existingentity), or deletes it if that returns None. 
+        
+        Optimistic: the entity is read and changed without the lock, which is then only held 
+        to check that the entity version is unchanged and store the result. If it did change,
+        answers 412 when ifmatch was given, otherwise starts over; the last of CASRETRIES 
+        attempts runs wholly under the lock. Raises KeyError for missing entity. 
+        '''
+        strict = ifmatch is not None and ifmatch.strip() != '*'
+        lock = self.persist.locks.getlock(key, entityname)
+        for attempt in range(InfoHandler.CASRETRIES):
+            pessimistic = (attempt == InfoHandler.CASRETRIES - 1)
+            if pessimistic:
+                self._acquire(lock)
+            try:
+                version = self.versions.getversion(key, entityname)
+                if strict and not self.matchetag(self.makeetag(version), ifmatch):
+                    cherrypy.response.status = 412
+                    return "Entity %s in key %s has changed. Current version is %s. " % (entityname, key, self.makeetag(version))
+                newentity = change(self.persist.getsnapshot().getentity(key, entityname))
+                if not pessimistic:
+                    self._acquire(lock)
+                try:
+                    if self.versions.getversion(key, entityname) != version:
+                        self.log.debug("Entity %s in key %s changed during update." % (entityname, key))
+                        if strict:
+                            cherrypy.response.status = 412
+                            return "Entity %s in key %s has changed. " % (entityname, key)
+                        continue
+                    if newentity is None:
+                        self.persist.deleteentity(key, entityname)
+                    else:
+                        self.persist.storeentity(key, entityname, newentity)
+                    newversion = self._written(key, entityname)
+                    cherrypy.response.headers['ETag'] = self.makeetag(newversion)
+                    self.log.debug("Successfully stored entity.")
+                    return None
+                finally:
+                    if not pessimistic:
+                        lock.release()
+            finally:
+                if pessimistic:
+                    lock.release()
+
+################################################################################
+#                     Path-oriented methods
+################################################################################
+
+    def splitpath(self, path):
+        '''
+        Splits dotted path "<entityname>.<attr>.<attr>..." into entityname and the rest. 
+        '''
+        names = path.split('.', 1)
+        if len(names) == 1:
+            return (names[0], None)
+        return (names[0], names[1])
+
+    def getpath(self, key, entityname, path, encodings=None):
+        '''
+        Gets JSON representation of the value at dotted path within entity, e.g. path 
+        "nodesets.0.name" in entity "site-x". List items are addressed by index. 
+        Compressed as for getentity(). 
+        '''
+        names = self._pathnames(path)
+        variant = ('path',) + tuple(names)
+        version = self.versions.getversion(key, entityname)
+        jv = self.cache.get(key, entityname, version, variant)
+        if jv is not None:
+            return self._encode(key, entityname, version, jv, encodings, variant)
+        try:
+            value = self._getpath(self.persist.getsnapshot().getentity(key, entityname), names)
+        except KeyError:
+            cherrypy.response.status = 405
+            return "Attempt to GET non-existent path %s in Entity %s. " % (path, entityname)
+        jv = self._dumps(value)
+        self.cache.put(key, entityname, jv, version, variant)
+        return self._encode(key, entityname, version, jv, encodings, variant)
+
+    def mergepath(self, key, entityname, path, jvalue, ifmatch=None):
+        '''
+        Merges JSON value into the value at dotted path within entity, in the way mergeentity() 
+        merges an entity: into a dictionary, the given attributes replace existing ones. Any other 
+        value is replaced. The path must exist up to its last element. 
+        '''
+        names = self._pathnames(path)
+        value = self._loads(jvalue)
+
+        def change(existingentity):
+            try:
+                current = self._getpath(existingentity, names)
+            except KeyError:
+                current = None
+            newvalue = value
+            if isinstance(current, dict) and isinstance(value, dict):
+                newvalue = dict(current)
+                self.entitymerge(value, newvalue)
+            return self._replacepath(existingentity, names, newvalue)
+
+        try:
+            msg = self._casentity(key, entityname, change, ifmatch)
+        except KeyError:
+            cherrypy.response.status = 405
+            return "Attempt to update (PUT) non-existent path %s in Entity %s. " % (path, entityname)
+        self.persist.sync()
+        return msg
+
+    def deletepath(self, key, entityname, path, ifmatch=None):
+        '''
+        Removes the value at dotted path within entity, or the entity itself if path is empty. 
+        '''
+        names = self._pathnames(path)
+        if not names:
+            return self.deleteentity(key, entityname, ifmatch)
+        try:
+            msg = self._casentity(key, entityname, 
+                                  lambda existingentity: self._replacepath(existingentity, names, None, delete=True), 
+                                  ifmatch)
+        except KeyError:
+            cherrypy.response.status = 405
+            return "Path %s in Entity %s not found, so can't delete it." % (path, entityname)
+        self.persist.sync()
+        return msg
+
+    def _pathnames(self, path):
+        if not path:
+            return []
+        return path.split('.')
+
+    def _pathindex(self, node, name):
+        '''
+        Returns index of path element name into node. Raises KeyError if node cannot have it. 
+        '''
+        if isinstance(node, dict):
+            return name
+        if isinstance(node, list):
+            try:
+                return int(name)
+            except ValueError:
+                raise KeyError(name)
+        raise KeyError(name)
+
+    def _getpath(self, node, names):
+        for name in names:
+            try:
+                node = node[self._pathindex(node, name)]
+            except IndexError:
+                raise KeyError(name)
+        return node
+
+    def _replacepath(self, node, names, value, delete=False):
+        '''
+        Returns copy of node with value at path names replaced by value, or deleted. Copies only 
+        the containers along the path, as stored values are never modified in place. 
+        Raises KeyError if the path does not exist. 
+        '''
+        if not names:
+            return value
+        index = self._pathindex(node, names[0])
+        if isinstance(node, list):
+            newnode = list(node)
+        else:
+            newnode = dict(node)
+        try:
+            if len(names) > 1:
+                newnode[index] = self._replacepath(node[index], names[1:], value, delete)
+            elif delete:
+                del newnode[index]
+            else:
+                newnode[index] = value
+        except IndexError:
+            raise KeyError(names[0])
+        return newnode
+
+################################################################################
+#                     Batch methods
+################################################################################
+
+    def batch(self, jops):
+        '''
+        Applies JSON list of entity operations, in order: 
+        
+         [ {"op": "create", "key": "user", "entityname": "jhover", "entity": {"name": "jhover", ...}},
+           {"op": "merge", "key": "project", "entityname": "atlas", "entity": {"members": [...]}},
+           {"op": "delete", "key": "user", "entityname": "angus"} ]
+        
+        Create, merge and delete work like POST, PUT and DELETE of an entity. All keys are 
+        locked at once, and each key's changes are stored with one write. 
+        
+        Returns JSON list of results, one per op: {"status": <HTTP status>, "message": <text>}, 
+        plus "etag" of the entity after the batch for successful ops. A failing op does not 
+        stop or undo the others. 
+        '''
+        try:
+            ops = self._loads(jops)
+        except ValueError, e:
+            cherrypy.response.status = 400
+            return "Batch is not valid JSON. (%s)" % e
+        if not isinstance(ops, list):
+            cherrypy.response.status = 400
+            return "Batch must be a list of operations."
+
+        results = [ None ] * len(ops)
+        keyops = {}
+        for (i, op) in enumerate(ops):
+            try:
+                if op['op'] not in ('create', 'merge', 'delete'):
+                    raise ValueError("unknown op %s" % op['op'])
+                if op['op'] != 'delete' and not isinstance(op['entity'], dict):
+                    raise ValueError("entity is not a dictionary")
+                if not op['entityname']:
+                    raise ValueError("no entityname")
+                keyops.setdefault(op['key'], []).append((i, op))
+            except (KeyError, TypeError, ValueError), e:
+                results[i] = { 'status' : 400, 'message' : "Invalid batch operation: %s" % e }
+
+        # always locked in the same order, so concurrent batches cannot deadlock. 
+        keys = sorted(keyops.keys())
+        locks = [ self.persist.locks.getlock(key) for key in keys ]
+        held = []
+        try:
+            for lock in locks:
+                self._acquire(lock)
+                held.append(lock)
+            for key in keys:
+                self._batchkey(key, keyops[key], results)
         finally:
-            self.persist.lock.release()   
+            for lock in reversed(held):
+                lock.release()
+        self.persist.sync()
+        return json.dumps(results)
+
+    def _batchkey(self, key, keyops, results):
+        '''
+        Applies batch ops [(index, op), ...] to key, with its lock held, and fills in results. 
+        '''
+        snapshot = self.persist.getsnapshot()
+        # entityname -> new entity, or None if deleted. 
+        changes = {}
+        done = []
+        for (i, op) in keyops:
+            name = op['entityname']
+            if name in changes:
+                existing = changes[name]
+            else:
+                try:
+                    existing = snapshot.getentity(key, name)
+                except KeyError:
+                    existing = None
+            if op['op'] == 'create':
+                if existing is not None:
+                    results[i] = { 'status' : 405, 'message' : "Entity %s already exists in key %s." % (name, key) }
+                    continue
+                changes[name] = op['entity']
+            elif existing is None:
+                results[i] = { 'status' : 405, 'message' : "Entity %s not found in key %s." % (name, key) }
+                continue
+            elif op['op'] == 'merge':
+                mergedentity = dict(existing)
+                self.entitymerge(op['entity'], mergedentity)
+                changes[name] = mergedentity
+            else:
+                changes[name] = None
+            done.append((i, name))
+        if not changes:
+            return
+        self.persist.storeentities(key, changes)
+        etags = {}
+        for name in changes.keys():
+            etags[name] = self.makeetag(self._written(key, name))
+        for (i, name) in done:
+            results[i] = { 'status' : 200, 'message' : "OK", 'etag' : etags[name] }
+        self.log.debug("Stored %d batch changes for key %s" % (len(changes), key))
 
 ################################################################################
 #                     Category document-oriented methods
@@ -197,59 +562,396 @@ class InfoHandler(object):
         Overwrites existing document with new.
         '''
         self.log.debug("Storing document for key %s" % key)
-        pd = json.loads(doc)
-        self.persist.lock.acquire()
+        self.metrics.setsize(key, len(doc))
+        pd = self._loads(doc)
+        lock = self.persist.locks.getlock(key)
+        self._acquire(lock)
         try:
             self.persist.storedocument(key, pd)
+            self._written(key)
         finally:
-            self.persist.lock.release()
+            lock.release()
+        self.persist.sync()
     
     def mergedocument(self, key, doc):
         self.log.debug("Merging document for key %s" % key)
-        self.persist.lock.acquire()
-        try:
-            dcurrent = self.persist.getdocument(key)
-            #pd = json.loads(doc)
-            
-            self.persist.storedocument(key, pd)
-        finally:
-            self.persist.lock.release()
-
-        self.persist.lock.acquire()
+        md = self._loads(doc)
+        self.log.debug("doc to merge is type %s" % type(md))
+        lock = self.persist.locks.getlock(key)
+        self._acquire(lock)
         try:
+            # merge() copies what it changes, so the stored document is left as it is.
             dcurrent = self.persist.getdocument(key)
             self.log.debug("current retrieved doc is type %s" % type(dcurrent))
-            md = json.loads(doc)
-            self.log.debug("doc to merge is type %s" % type(md))
+            start = time.time()
             newdoc = self.merge( md, dcurrent)
+            self.metrics.observe('merge.document', time.time() - start)
             self.log.debug("Merging document for key %s" % key)
             self.persist.storedocument(key, newdoc)
+            self._written(key)
         finally:
-            self.persist.lock.release()      
+            lock.release()
+        self.persist.sync()
 
     def deletedocument(self, key):
         self.log.debug("Deleting document for key %s" % key)
-        #pd = json.loads(doc)
-        self.persist.lock.acquire()
+        #pd = self._loads(doc)
+        lock = self.persist.locks.getlock(key)
+        self._acquire(lock)
         emptydict = {}
         try:
             self.persist.storedocument(key, emptydict)
+            self._written(key)
         finally:
-            self.persist.lock.release()
+            lock.release()
+        self.persist.sync()
 
-    def getdocument(self, key):
+    def getdocument(self, key, encodings=None, fields=None, where=None, limit=None, after=None, stream=False):
         '''
         Gets JSON representation of document. 
+        Only attributes in list fields of each entity, if given. Only entities matching JSON 
+        filter where, if given, as for findentities(). Compressed if large enough and one of 
+        encodings can be used, as for getentity(). 
+        
+        With limit, gets one page of at most limit entities in entity name order, starting 
+        after entity name <after>, if given: 
+        
+          {"entities": {"jhover": {...}, ...}, "next": <after for next page, or null if last>}
+        
+        With stream, returns generator yielding the document in pieces instead, not cached 
+        or compressed, so it is never encoded as a whole. 
         '''
-        pd = self.persist.getdocument(key)
-        jd = json.dumps(pd)
+        variant = self._fieldsvariant(fields)
+        if where is not None:
+            try:
+                conditions = json.loads(where)
+                if not isinstance(conditions, dict):
+                    raise ValueError("not a dictionary")
+            except ValueError, e:
+                cherrypy.response.status = 400
+                return "Invalid where filter %s (%s)" % (where, e)
+            variant = ('where', json.dumps(conditions, sort_keys=True), variant)
+        if limit is not None:
+            variant = ('page', limit, after, variant)
+        version = self.versions.getversion(key)
+        if not stream:
+            jd = self.cache.get(key, None, version, variant)
+            if jd is not None:
+                return self._encode(key, None, version, jd, encodings, variant)
+        if where is not None:
+            pd = self.findentities(key, conditions)
+        else:
+            pd = self.persist.getsnapshot().getdocument(key)
+        if stream:
+            cherrypy.response.stream = True
+            return self._streamdocument(pd, fields)
+        if limit is not None:
+            if where is None:
+                names = self._sortednames(key, version, pd)
+            else:
+                names = sorted(pd.keys())
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(names, after)
+            pagenames = names[start:start + limit]
+            nextname = None
+            if start + limit < len(names):
+                nextname = pagenames[-1]
+            pd = { 'entities' : dict([ (name, self._project(pd[name], fields)) for name in pagenames if name in pd ]), 
+                   'next' : nextname }
+        elif fields is not None:
+            pd = dict([ (name, self._project(entity, fields)) for (name, entity) in pd.items() ])
+        jd = self._dumps(pd)
+        if variant is None:
+            self.metrics.setsize(key, len(jd))
         self.log.debug("d is type %s" % type(jd))
-        return jd
+        self.cache.put(key, None, jd, version, variant)
+        return self._encode(key, None, version, jd, encodings, variant)
 
 ################################################################################
 #                     Utility methods
 ################################################################################
 
+    def findentities(self, key, conditions):
+        '''
+        Returns dict of the entities of key matching all of conditions {attribute: value, ...}. 
+        An attribute matches a value equal to it or, if it is a list, containing it. 
+        
+        Uses the indexes of key for the attributes it has them for. Candidates are 
+        checked against the store, so index entries of concurrent writes do no harm. 
+        '''
+        snapshot = self.persist.getsnapshot()
+        names = None
+        for (attribute, value) in conditions.items():
+            found = self.indexes.lookup(key, attribute, value)
+            if found is None:
+                continue
+            if names is None:
+                names = found
+            else:
+                names = names & found
+        if names is None:
+            self.log.debug("No index for %s in key %s, scanning." % (conditions.keys(), key))
+            candidates = snapshot.getdocument(key).items()
+        else:
+            candidates = []
+            for name in names:
+                try:
+                    candidates.append((name, snapshot.getentity(key, name)))
+                except KeyError:
+                    pass
+        found = {}
+        for (name, entity) in candidates:
+            if self._matches(entity, conditions):
+                found[name] = entity
+        return found
+
+    def _matches(self, entity, conditions):
+        if not isinstance(entity, dict):
+            return False
+        for (attribute, value) in conditions.items():
+            try:
+                actual = entity[attribute]
+            except KeyError:
+                return False
+            if actual != value and not (isinstance(actual, list) and value in actual):
+                return False
+        return True
+
+    def getetag(self, key, entityname=None):
+        '''
+        Returns HTTP entity tag for current version of document, or of entity if given. 
+        '''
+        return self.makeetag(self.versions.getversion(key, entityname))
+
+    def makeetag(self, version):
+        return '"%s-%d"' % (self.versions.epoch, version)
+
+    def encodedetag(self, etag):
+        '''
+        ETag of the response being sent for version tag etag: tagged with its Content-Encoding,
+        if any, so compressed and plain representations do not share a strong ETag. 
+        '''
+        encoding = cherrypy.response.headers.get('Content-Encoding')
+        if encoding is None:
+            return etag
+        return '%s+%s"' % (etag[:-1], encoding)
+
+    def matchetag(self, etag, header):
+        '''
+        Returns the tag of an If-None-Match or If-Match header value matching version tag etag,
+        or None. Tags of encoded representations (see encodedetag()) match the version they 
+        encode. 
+        '''
+        if header is None:
+            return None
+        for tag in [ t.strip() for t in header.split(',') ]:
+            if tag == '*':
+                return etag
+            if tag.endswith('"') and '+' in tag:
+                if tag[:tag.rindex('+')] + '"' == etag:
+                    return tag
+            elif tag == etag:
+                return tag
+        return None
+
+    def _sortednames(self, key, version, doc):
+        '''
+        Sorted entity names of doc, read at version of key. Kept per key until it changes, so 
+        paging through a document sorts it only once. 
+        '''
+        self.nameslock.acquire()
+        try:
+            try:
+                (namesversion, names) = self.sortednames[key]
+                if namesversion == version:
+                    return names
+            except KeyError:
+                pass
+        finally:
+            self.nameslock.release()
+        names = sorted(doc.keys())
+        self.nameslock.acquire()
+        try:
+            self.sortednames[key] = (version, names)
+        finally:
+            self.nameslock.release()
+        return names
+
+    def _streamdocument(self, doc, fields):
+        '''
+        Yields JSON encoding of doc entity by entity, in chunks of about STREAMCHUNK bytes. 
+        '''
+        chunk = [ '{' ]
+        size = 1
+        separator = ''
+        for (name, entity) in doc.iteritems():
+            part = '%s%s: %s' % (separator, json.dumps(name), json.dumps(self._project(entity, fields)))
+            separator = ', '
+            chunk.append(part)
+            size += len(part)
+            if size >= InfoHandler.STREAMCHUNK:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append('}')
+        yield ''.join(chunk)
+
+    def _project(self, entity, fields):
+        '''
+        Returns entity with only the attributes in list fields, or whole if fields is None. 
+        '''
+        if fields is None or not isinstance(entity, dict):
+            return entity
+        return dict([ (f, entity[f]) for f in fields if f in entity ])
+
+    def _fieldsvariant(self, fields):
+        '''
+        Cache variant of responses projected to fields.
+        '''
+        if fields is None:
+            return None
+        return ('fields',) + tuple(sorted(set(fields)))
+
+    def _encode(self, key, entityname, version, data, encodings, variant=None):
+        '''
+        Returns JSON response data in the first of encodings we can produce, and sets 
+        Content-Encoding accordingly, if it is at least compressminbytes long. Compressed 
+        responses are cached next to the plain one (cached as variant, if any). 
+        '''
+        if not self.compress:
+            return data
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if len(data) < self.compressminbytes:
+            return data
+        for encoding in encodings or []:
+            if encoding in InfoHandler.ENCODINGS:
+                break
+        else:
+            return data
+        if variant is not None:
+            zvariant = (variant, encoding)
+        else:
+            zvariant = encoding
+        zd = self.cache.get(key, entityname, version, zvariant)
+        if zd is None:
+            z = zlib.compressobj(self.compresslevel, zlib.DEFLATED, InfoHandler.ENCODINGS[encoding])
+            zd = z.compress(data) + z.flush()
+            self.log.debug("Compressed %d bytes to %d with %s" % (len(data), len(zd), encoding))
+            self.cache.put(key, entityname, zd, version, zvariant)
+        cherrypy.response.headers['Content-Encoding'] = encoding
+        return zd
+
+    def _acquire(self, lock):
+        '''
+        Acquires persistence lock, recording the time spent waiting for it. 
+        '''
+        start = time.time()
+        lock.acquire()
+        self.metrics.observe('lockwait', time.time() - start)
+
+    def _loads(self, s):
+        start = time.time()
+        try:
+            return json.loads(s)
+        finally:
+            self.metrics.observe('json.loads', time.time() - start)
+
+    def _dumps(self, o):
+        start = time.time()
+        try:
+            return json.dumps(o)
+        finally:
+            self.metrics.observe('json.dumps', time.time() - start)
+
+    def _written(self, key, entityname=None):
+        '''
+        Bookkeeping after a write to key (to entityname only, if given). Called with the key 
+        lock held, after the plugin has stored the change. Returns new key version. 
+        '''
+        # before the version changes, so readers of the new version find an up-to-date index. 
+        self._reindex(key, entityname)
+        version = self.changes.record(key, entityname, self.versions.bump)
+        self.cache.invalidate(key, entityname)
+        if self.publisher is not None:
+            self.publisher.publish(key, entityname, version)
+        return version
+
+    def _reindex(self, key, entityname=None):
+        if self.indexes.isindexed(key):
+            snapshot = self.persist.getsnapshot()
+            if entityname is None:
+                self.indexes.reindexdocument(key, snapshot.getdocument(key))
+            else:
+                try:
+                    self.indexes.reindexentity(key, entityname, snapshot.getentity(key, entityname))
+                except KeyError:
+                    self.indexes.reindexentity(key, entityname, None)
+
+    def parseetag(self, etag):
+        '''
+        Returns (epoch, version) of ETag made by makeetag(), or None if it is not one. 
+        '''
+        try:
+            (epoch, version) = etag.strip().lstrip('W/').strip('"').split('+')[0].rsplit('-', 1)
+            return (epoch, int(version))
+        except ValueError:
+            return None
+
+################################################################################
+#                     Change feed methods
+################################################################################
+
+    def watch(self, key, since=None, entityname=None, timeout=None):
+        '''
+        Waits until key (entityname only, if given) has changed since version <since>, 
+        an ETag as returned by GET or by a previous watch, or until timeout seconds have passed.
+        Without since, waits for the next change. Returns JSON doc string: 
+        
+          {"key": "user", "etag": <etag>, "changed": true, 
+           "entities": ["jhover", "lincolnb"], "resync": false}
+         
+        entities are the entities written since <since>, and etag the version to pass as 
+        <since> next time. resync means the changed entities are not known, because a whole 
+        document was written, the changes are too old to be kept, or the service restarted: 
+        the client must read the whole document again. 
+        '''
+        if timeout is None:
+            timeout = self.maxwatchtimeout
+        timeout = min(max(float(timeout), 0.0), self.maxwatchtimeout)
+        if since is None:
+            sinceversion = self.versions.getversion(key, entityname)
+        else:
+            tag = self.parseetag(since)
+            if tag is not None and tag[0] == self.versions.epoch:
+                sinceversion = tag[1]
+            else:
+                # tag from before a restart, or not one of ours. 
+                sinceversion = None
+
+        if sinceversion is None:
+            self.log.debug("Watch of key %s since %s needs resync." % (key, since))
+            version = self.versions.getversion(key, entityname)
+            (changed, names, complete) = (True, [], False)
+        else:
+            if self.changes.waiting >= self.maxwatchers:
+                cherrypy.response.status = 503
+                cherrypy.response.headers['Retry-After'] = '1'
+                return "Too many watchers. Try again later."
+            (version, names, complete) = self.changes.wait(key, sinceversion, entityname, timeout, 
+                                                           self.versions.getversion)
+            changed = version > sinceversion
+        if entityname is not None:
+            # entity versions include document writes, so re-reading the entity is enough. 
+            (names, complete) = ([entityname] if changed else [], True)
+        etag = self.makeetag(version)
+        cherrypy.response.headers['ETag'] = etag
+        return json.dumps({'key' : key, 
+                           'etag' : etag, 
+                           'changed' : changed, 
+                           'entities' : names, 
+                           'resync' : not complete})
+
 #    def _getpythondocument(self, key):
 #        '''
 #        Gets Python object. 
@@ -263,13 +965,6 @@ class InfoHandler(object):
 #        self.persist.storedocument(key, pd)
     
     
-#    def deletesubtree(self, path):
-#        lst = path.split('.')
-#        try:
-#            self.persist.deletesubtree(lst)
-#        except IndexError:
-#            raise Exception('path should have more than one key')
-
     def merge(self, src, dest):
             ''' 
             Merges python primitive object src into dest and returns merged result.
@@ -278,85 +973,172 @@ class InfoHandler(object):
             Primitive values are overwritten. 
             NOTE: tuples and arbitrary objects are not handled as it is totally ambiguous what should happen
             https://stackoverflow.com/questions/7204805/dictionaries-of-dictionaries-merge/15836901
+
+            Works through the documents with an explicit stack rather than recursion, so depth 
+            is not bounded by the recursion limit. List items already in dest are found by 
+            hashing (see _mergelist), not by scanning dest for each one.
+
+            dest is not modified: the dicts and lists along the paths src changes are copied, 
+            the rest is shared with the result. 
             '''
-            key = None
-            # ## debug output
-            # sys.stderr.write("DEBUG: %s to %s\n" %(b,a))
-            self.log.debug("Handling merging %s into %s " % (src, dest))
-            try:
-                if dest is None or isinstance(dest, str) or isinstance(dest, unicode) or isinstance(dest, int) \
-                             or isinstance(dest, long) or isinstance(dest, float):
-                    # border case for first run or if a is a primitive
-                    dest = src
-                elif isinstance(dest, list):
-                    # lists can be only appended
-                    if isinstance(src, list):
-                        # merge lists
-                        for item in src:
-                            if item not in dest:
-                                dest.append(item)
-                        #dest.extend(src)
-                    else:
-                        self.log.error("Refusing to add non-list %s to list %s" % (src, dest))
-                        # append to list
-                        #dest.append(src)
-                elif isinstance(dest, dict):
-                    # dicts must be merged
-                    if isinstance(src, dict):
-                        for key in src:
-                            if key in dest:
-                                dest[key] = self.merge(src[key], dest[key])
-                            else:
-                                dest[key] = src[key]
-                    elif src is None:
-                        dest = None
-                    else:
-                        self.log.warning("Cannot merge non-dict %s into dict %s" % (src, dest))
+            self.log.debug("Handling merging %s into %s", src, dest)
+            # (src, dict in dest holding the value to merge it into, key of that value)
+            pending = []
+            dest = self._mergenode(src, dest, None, pending)
+            while pending:
+                (s, parent, key) = pending.pop()
+                parent[key] = self._mergenode(s, parent[key], key, pending)
+            return dest
+
+    def _mergenode(self, src, dest, key, pending):
+        '''
+        One merge() step: merges src into dest, except that for dicts, values present in 
+        both are queued on pending instead of being merged here. Returns merged result. 
+        '''
+        try:
+            if dest is None or isinstance(dest, str) or isinstance(dest, unicode) or isinstance(dest, int) \
+                         or isinstance(dest, long) or isinstance(dest, float):
+                # border case for first run or if a is a primitive
+                dest = src
+            elif isinstance(dest, list):
+                # lists can be only appended
+                if isinstance(src, list):
+                    dest = self._mergelist(src, dest)
+                else:
+                    self.log.error("Refusing to add non-list %s to list %s", src, dest)
+            elif isinstance(dest, dict):
+                # dicts must be merged
+                if isinstance(src, dict):
+                    # values merged below are stored into this copy. 
+                    dest = dict(dest)
+                    for k in src:
+                        if k in dest:
+                            pending.append((src[k], dest, k))
+                        else:
+                            dest[k] = src[k]
+                elif src is None:
+                    dest = None
                 else:
-                    raise Exception('NOT IMPLEMENTED "%s" into "%s"' % (src, dest))
-            except TypeError, e:
-                raise Exception('TypeError "%s" in key "%s" when merging "%s" into "%s"' % (e, key, src, dest))
+                    self.log.warning("Cannot merge non-dict %s into dict %s", src, dest)
+            else:
+                raise Exception('NOT IMPLEMENTED "%s" into "%s"' % (src, dest))
+        except TypeError, e:
+            raise Exception('TypeError "%s" in key "%s" when merging "%s" into "%s"' % (e, key, src, dest))
+        return dest
+
+    def _mergelist(self, src, dest):
+        '''
+        Returns list dest with the items of list src not yet in it appended, in order, as a 
+        new list if any is. Items are looked up in a set, unhashable ones by their _frozen() form.
+        '''
+        if not src:
             return dest
+        added = []
+        seen = set()
+        for item in dest:
+            try:
+                seen.add(item)
+            except TypeError:
+                seen.add(self._frozen(item))
+        for item in src:
+            try:
+                if item in seen:
+                    continue
+                seen.add(item)
+            except TypeError:
+                fi = self._frozen(item)
+                if fi in seen:
+                    continue
+                seen.add(fi)
+            added.append(item)
+        if added:
+            return dest + added
+        return dest
+
+    def _frozen(self, value):
+        '''
+        Hashable copy of JSON value <value>, equal to the copy of another value exactly 
+        when the values are equal: dicts become frozensets of items, lists tuples. 
+        '''
+        if isinstance(value, dict):
+            return frozenset([ (k, self._frozen(v)) for (k, v) in value.iteritems() ])
+        elif isinstance(value, list):
+            return tuple([ self._frozen(v) for v in value ])
+        return value
 
 
 ##################################################################################
 #                             Infrastructural methods 
 ##################################################################################
     
-    def getpairing(self, key, pairingcode):
+    def getpairing(self, key, pairingcode, wait=None):
         '''
-        Pull pairing document, check each entry to see if <entry>.pairingcode = pairingcode.
-        If so, and cert and key are not none, prepare to return them, delete entry, return Pairing
+        Returns the pairing entry of document <key> with pairingcode, as JSON, once its cert 
+        is filled in (see takepairing()). If it is not, waits up to <wait> seconds (at most 
+        maxwatchtimeout) for a write to <key> that fills it in, rather than answering 404 at 
+        once. Waiting requests count as watchers.
         '''
         failmsg="Invalid pairing code or not satisfied yet. Try in 30 seconds."
+        if wait is None:
+            wait = 0.0
+        deadline = time.time() + min(max(float(wait), 0.0), self.maxwatchtimeout)
+        while True:
+            # version read first, so a write after the attempt below ends the wait. 
+            version = self.versions.getversion(key)
+            prd = self.takepairing(key, pairingcode)
+            if prd is not None:
+                return prd
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.changes.closed or self.changes.waiting >= self.maxwatchers:
+                break
+            self.log.debug("Waiting %.1f s for pairing %s." % (remaining, pairingcode))
+            self.changes.wait(key, version, None, remaining, self.versions.getversion)
+        cherrypy.response.status = 404
+        return failmsg
+
+    def takepairing(self, key, pairingcode):
+        '''
+        Finds the entry of document <key> with <entry>.pairingcode = pairingcode, through the 
+        pairingcode index. If its cert and key are not None, deletes the entry and returns it 
+        as JSON, so each pairing is handed out exactly once. Otherwise returns None. 
+        '''
         prd = None
-        pd = self._getpythondocument(key)
-        self.log.debug("Received dict: %s" % pd)
-        try:        
-            self.log.debug("Entries are %s" % pd[key] )
-            for p in pd[key].keys():
-                self.log.debug("Checking entry %s for pairingcode..." % p)
-                if pd[key][p]['pairingcode'] == pairingcode:
-                    self.log.debug("Found matching entry %s value %s" % (p, pd[key][p]))
-                    if pd[key][p]['cert'] is not None:
-                        prd = json.dumps(pd[key][p])
-                        try:
-                            self.log.debug("Attempting to delete entry %s from pairing." % p)
-                            pd[key].pop(p, None)
-                            self.log.debug("Deleted entry %s from pairing. Re-storing.." % p)
-                        except KeyError:
-                            self.log.warning("Failed to delete entry %s from pairing." % p)
-                        self._storepythondocument(key, pd)
-                    else:
-                        self.log.info("Certificate for requested pairing not generated yet.")
-            self.log.debug("Returning pairing entry JSON %s" % prd)
-            if prd is None:
-                cherrypy.response.headers["Status"] = "404"
-                return failmsg
-            return prd
-        except KeyError:
-            cherrypy.response.headers["Status"] = "404"
-            return failmsg
+        for name in sorted(self.findentities(key, {'pairingcode' : pairingcode}).keys()):
+            self.log.debug("Found matching entry %s" % name)
+            lock = self.persist.locks.getlock(key, name)
+            self._acquire(lock)
+            try:
+                # re-checked under the lock: only one of concurrent requests may take the entry. 
+                try:
+                    pe = self.persist.getsnapshot().getentity(key, name)
+                except KeyError:
+                    self.log.debug("Entry %s already retrieved." % name)
+                    continue
+                if pe.get('pairingcode') != pairingcode:
+                    continue
+                if pe.get('cert') is None:
+                    self.log.info("Certificate for requested pairing not generated yet.")
+                    continue
+                self.log.debug("Attempting to delete entry %s from pairing." % name)
+                self.persist.deleteentity(key, name)
+                self._written(key, name)
+                prd = json.dumps(pe)
+                break
+            finally:
+                lock.release()
+        if prd is None:
+            return None
+        self.persist.sync()
+        self.log.debug("Returning pairing entry %s" % name)
+        return prd
+
+    def shutdown(self):
+        '''
+        Lets the persistence plugin flush outstanding writes before the service exits. 
+        '''
+        self.changes.close()
+        self.log.debug("Shutting down persistence plugin...")
+        self.persist.shutdown()
 
     def getCAChain(self):
         '''
@@ -365,87 +1147,1377 @@ class InfoHandler(object):
         pass
    
 
-class InfoRoot(object):
-
-    @cherrypy.expose
-    def index(self):
-        return "Nothing to see. Go to /info"    
-
-    @cherrypy.expose
-    def generate(self, length=8):
-        return ''.join(random.sample(string.hexdigits, int(length)))
-
-class InfoServiceAPI(object):
-    ''' 
-        Data at this level is assumed to be  JSON text/plain. 
-    
+class InfoResponseCache(object):
     '''
-    exposed = True 
+    Least-recently-used cache of JSON-encoded GET responses, per document key and per 
+    (key, entityname), bounded to maxbytes of encoded data. Each may also have variants, 
+    e.g. compressed encodings, cached alongside under the same version. 
     
-    def __init__(self, config):
+    Entries are tagged with the version they were read at, and only returned for that version.
+    Readers take the version before reading the store, so an entry is never newer-labelled 
+    than its content. InfoHandler also invalidates a key after each write, to free the space. 
+    '''
+    def __init__(self, maxbytes):
         self.log = logging.getLogger()
-        self.log.debug("Initting InfoServiceAPI...")
-        self.infohandler = InfoHandler(config)
-        self.log.debug("InfoServiceAPI init done." )
-    
-    def GET(self, key, pairingcode=None, entityname=None):
-        if pairingcode is None and entityname is None:
-            d = self.infohandler.getdocument(key) 
-            self.log.debug("Document retrieved for key %s " % key)
-            return d
-        elif pairingcode is None:
-            e = self.infohandler.getentity(key, entityname) 
-            self.log.debug("Entity retrieved for key %s and name %s" % (key,entityname))
-            return e
-        else:
-            self.log.debug("Handling pairing retrieval")
-            d = self.infohandler.getpairing(key, pairingcode)
-            self.log.debug("Pairing retrieved for code %s with val %s" % (pairingcode,d))
-            return d
+        self.lock = threading.Lock()
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        # key -> entityname -> cache keys of its variants
+        self.entitykeys = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, entityname, version, variant=None):
+        '''
+        Returns cached encoding for version, or None. 
+        '''
+        ckey = (key, entityname, variant)
+        self.lock.acquire()
+        try:
+            try:
+                (cachedversion, data) = self.entries.pop(ckey)
+            except KeyError:
+                self.misses += 1
+                return None
+            if cachedversion != version:
+                self._forget(ckey, data)
+                self.misses += 1
+                return None
+            # re-insert as most recently used.
+            self.entries[ckey] = (cachedversion, data)
+            self.hits += 1
+            return data
+        finally:
+            self.lock.release()
 
-    @cherrypy.tools.accept(media='text/plain')
-    def PUT(self, key, entityname=None, data=None):
-        rtext = "Something went wrong..."
-        if entityname is None:
-            self.log.debug("Storing document %s" % data)
-            self.infohandler.mergedocument(key, data)
-            self.log.debug("Document stored for key %s" % key)
-            rtext= "Document stored for key %s\n" % key
-        else:
-            self.log.debug("Storing key %s entityname %s " % (key, entityname))
-            self.infohandler.mergeentity(key, entityname, data)
-            rtext= "Entity %s stored in key %s\n" % (entityname, key )
-        return rtext
+    def put(self, key, entityname, data, version, variant=None):
+        ckey = (key, entityname, variant)
+        self.lock.acquire()
+        try:
+            if len(data) > self.maxbytes:
+                return
+            self._remove(ckey)
+            self.entries[ckey] = (version, data)
+            self.entitykeys.setdefault(key, {}).setdefault(entityname, set()).add(ckey)
+            self.size += len(data)
+            while self.size > self.maxbytes:
+                self._remove(next(iter(self.entries)))
+        finally:
+            self.lock.release()
 
-        
-    def POST(self, key, entityname=None, data=None):
-        rtext = "Something went wrong..."
-        if entityname is None:
-            self.log.debug("Storing document %s" % data)
-            self.infohandler.storedocument(key, data)
-            self.log.debug("Document stored for key %s" % key)
-            rtext= "Document stored for key %s\n" % key
-        else:
-            self.log.debug("Storing key %s entityname %s " % (key, entityname))
-            self.infohandler.storeentity(key, entityname, data)
-            rtext= "Entity %s stored in key %s\n" % (entityname, key )
-        return rtext
-        
-    def DELETE(self, key, entityname ):
+    def invalidate(self, key, entityname=None):
         '''
-        Deletes specified entity from <key> document. 
+        Drops the document responses for key, plus the responses for entityname if given, 
+        or for all entities of key if not. 
         '''
-        self.infohandler.deleteentity(key, entityname)
-        rtext= "Entity %s deleted in key %s\n" % (entityname, key )
-        return rtext
-
+        self.lock.acquire()
+        try:
+            self.invalidations += 1
+            names = self.entitykeys.get(key, {})
+            if entityname is None:
+                ckeys = [ ckey for ename in names for ckey in names[ename] ]
+            else:
+                ckeys = list(names.get(None, [])) + list(names.get(entityname, []))
+            for ckey in ckeys:
+                self._remove(ckey)
+        finally:
+            self.lock.release()
+
+    def getstats(self):
+        self.lock.acquire()
+        try:
+            return { 'hits' : self.hits,
+                     'misses' : self.misses,
+                     'invalidations' : self.invalidations,
+                     'entries' : len(self.entries),
+                     'bytes' : self.size,
+                     'maxbytes' : self.maxbytes }
+        finally:
+            self.lock.release()
+
+    def _remove(self, ckey):
+        try:
+            (version, data) = self.entries.pop(ckey)
+        except KeyError:
+            return
+        self._forget(ckey, data)
+
+    def _forget(self, ckey, data):
+        self.size -= len(data)
+        (key, entityname, variant) = ckey
+        names = self.entitykeys[key]
+        names[entityname].discard(ckey)
+        if not names[entityname]:
+            del names[entityname]
+            if not names:
+                del self.entitykeys[key]
+
+
+class InfoIndexTable(object):
+    '''
+    Secondary indexes on entity attributes, for the keys and attributes configured in 
+    [indexes]. Maps each attribute value to the names of the entities having it. List values 
+    are indexed by item. Values that cannot be hashed (dictionaries, lists in lists) are not
+    indexed: filters on them fall back to scanning. 
+    
+    InfoHandler reindexes an entity after every write to it, with the key lock held. Each 
+    entity's indexed values are remembered, so old entries are dropped without reading the 
+    old entity. 
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> attribute -> value -> set of entitynames
+        self.indexes = {}
+        # key -> entityname -> [(attribute, value), ...]
+        self.entries = {}
+
+    def addindex(self, key, attributes, doc):
+        self.lock.acquire()
+        try:
+            self.indexes[key] = dict([ (a, {}) for a in attributes ])
+            self.entries[key] = {}
+            for (name, entity) in doc.items():
+                self._reindex(key, name, entity)
+        finally:
+            self.lock.release()
+
+    def isindexed(self, key):
+        return key in self.indexes
+
+    def reindexentity(self, key, entityname, entity):
+        '''
+        Updates index for new entity value, or None if deleted. 
+        '''
+        self.lock.acquire()
+        try:
+            self._reindex(key, entityname, entity)
+        finally:
+            self.lock.release()
+
+    def reindexdocument(self, key, doc):
+        self.lock.acquire()
+        try:
+            for name in list(self.entries[key].keys()):
+                if name not in doc:
+                    self._reindex(key, name, None)
+            for (name, entity) in doc.items():
+                self._reindex(key, name, entity)
+        finally:
+            self.lock.release()
+
+    def lookup(self, key, attribute, value):
+        '''
+        Returns set of names of entities of key having attribute value, or None if that is not indexed. 
+        '''
+        if not self._hashable(value):
+            return None
+        self.lock.acquire()
+        try:
+            try:
+                index = self.indexes[key][attribute]
+            except KeyError:
+                return None
+            return set(index.get(value, ()))
+        finally:
+            self.lock.release()
+
+    def _reindex(self, key, entityname, entity):
+        index = self.indexes[key]
+        for (attribute, value) in self.entries[key].pop(entityname, []):
+            names = index[attribute][value]
+            names.discard(entityname)
+            if not names:
+                del index[attribute][value]
+        if not isinstance(entity, dict):
+            return
+        entries = []
+        for attribute in index.keys():
+            if attribute not in entity:
+                continue
+            value = entity[attribute]
+            if isinstance(value, list):
+                values = set([ v for v in value if self._hashable(v) ])
+            elif self._hashable(value):
+                values = [ value ]
+            else:
+                continue
+            for v in values:
+                index[attribute].setdefault(v, set()).add(entityname)
+                entries.append((attribute, v))
+        if entries:
+            self.entries[key][entityname] = entries
+
+    def _hashable(self, value):
+        try:
+            hash(value)
+            return True
+        except TypeError:
+            return False
+
+
+class InfoVersionTable(object):
+    '''
+    Monotonic version counters per document key and per entity, bumped by InfoHandler on 
+    every write. 
+    
+    A key's version counts all writes to it. An entity's version is the key version of its 
+    last entity-level write, or of the last document-level write to its key, whichever is 
+    later, since a document write may have changed any entity. Counters start over when the 
+    service restarts, so tags carry an epoch that changes with every start. 
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = '%x' % int(time.time() * 1000)
+        self.keys = {}
+        self.documentwrites = {}
+        self.entities = {}
+
+    def getversion(self, key, entityname=None):
+        self.lock.acquire()
+        try:
+            if entityname is None:
+                return self.keys.get(key, 0)
+            return max(self.entities.get((key, entityname), 0), self.documentwrites.get(key, 0))
+        finally:
+            self.lock.release()
+
+    def bump(self, key, entityname=None):
+        '''
+        Records a write to key (to entityname only, if given). Returns new key version. 
+        '''
+        self.lock.acquire()
+        try:
+            version = self.keys.get(key, 0) + 1
+            self.keys[key] = version
+            if entityname is None:
+                self.documentwrites[key] = version
+            else:
+                self.entities[(key, entityname)] = version
+            return version
+        finally:
+            self.lock.release()
+
+    def setversion(self, key, entityname, version):
+        '''
+        Records a write of key version <version> made by another process (see InfoWriter).
+        Replayed writes are ignored, so replicas can apply them more than once.
+        '''
+        self.lock.acquire()
+        try:
+            self.keys[key] = max(self.keys.get(key, 0), version)
+            if entityname is None:
+                self.documentwrites[key] = max(self.documentwrites.get(key, 0), version)
+            else:
+                self.entities[(key, entityname)] = max(self.entities.get((key, entityname), 0), version)
+            return version
+        finally:
+            self.lock.release()
+
+    def getstate(self):
+        self.lock.acquire()
+        try:
+            return (self.epoch, dict(self.keys), dict(self.documentwrites), dict(self.entities))
+        finally:
+            self.lock.release()
+
+    def setstate(self, state):
+        self.lock.acquire()
+        try:
+            (self.epoch, self.keys, self.documentwrites, self.entities) = state
+        finally:
+            self.lock.release()
+
+
+class InfoMetrics(object):
+    '''
+    Request counts and latency histograms, per HTTP method and operation, and for the parts
+    of handling a request (lock waits, JSON coding, merges, persistence calls). Plus request
+    counts per document key, and the last known encoded size of each document. 
+    
+    start_request() and end_request() are CherryPy hooks, timing every request. 
+    '''
+    # upper bounds (seconds) of histogram buckets. The last bucket holds the rest. 
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # distinct document keys counted, so bogus keys cannot grow the table without bound.
+    MAXKEYS = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # name -> [count, sum, max, [count per bucket]]
+        self.histograms = {}
+        self.statuses = {}
+        self.keys = {}
+        self.sizes = {}
+        self.inflight = 0
+        self.maxinflight = 0
+
+    def observe(self, name, seconds):
+        i = bisect.bisect_left(InfoMetrics.BUCKETS, seconds)
+        self.lock.acquire()
+        try:
+            h = self.histograms.get(name)
+            if h is None:
+                h = [ 0, 0.0, 0.0, [ 0 ] * (len(InfoMetrics.BUCKETS) + 1) ]
+                self.histograms[name] = h
+            h[0] += 1
+            h[1] += seconds
+            if seconds > h[2]:
+                h[2] = seconds
+            h[3][i] += 1
+        finally:
+            self.lock.release()
+
+    def setsize(self, key, nbytes):
+        self.lock.acquire()
+        try:
+            if key in self.sizes or len(self.sizes) < InfoMetrics.MAXKEYS:
+                self.sizes[key] = nbytes
+        finally:
+            self.lock.release()
+
+    def start_request(self):
+        cherrypy.request.infostart = time.time()
+        self.lock.acquire()
+        try:
+            self.inflight += 1
+            self.maxinflight = max(self.maxinflight, self.inflight)
+        finally:
+            self.lock.release()
+
+    def end_request(self):
+        request = cherrypy.request
+        try:
+            seconds = time.time() - request.infostart
+        except AttributeError:
+            # failed before the resource was found. 
+            return
+        operation = '%s %s' % (request.method, request.script_name or '/')
+        if request.script_name == '/info':
+            operation += ' ' + self.getoperation(request.params)
+        key = request.params.get('key')
+        status = '%sxx' % str(cherrypy.response.status or 200)[0]
+        self.observe(operation, seconds)
+        self.lock.acquire()
+        try:
+            self.inflight -= 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if isinstance(key, basestring) and (key in self.keys or len(self.keys) < InfoMetrics.MAXKEYS):
+                k = self.keys.setdefault(key, {})
+                k[request.method] = k.get(request.method, 0) + 1
+        finally:
+            self.lock.release()
+
+    def getoperation(self, params):
+        '''
+        Kind of /info request, by its parameters. 
+        '''
+        for (param, operation) in [ ('pairingcode', 'pairing'), ('path', 'path'), ('entityname', 'entity'), 
+                                    ('stream', 'stream'), ('limit', 'page'), ('where', 'where') ]:
+            if param in params:
+                return operation
+        return 'document'
+
+    def getstats(self):
+        self.lock.acquire()
+        try:
+            histograms = {}
+            for (name, (count, total, maximum, buckets)) in self.histograms.items():
+                histograms[name] = { 'count' : count, 
+                                     'sum' : total, 
+                                     'max' : maximum, 
+                                     'mean' : total / count,
+                                     'p50' : self._quantile(count, buckets, 0.5, maximum),
+                                     'p99' : self._quantile(count, buckets, 0.99, maximum),
+                                     'buckets' : list(buckets) }
+            return { 'uptime' : time.time() - self.started,
+                     'inflight' : self.inflight,
+                     'maxinflight' : self.maxinflight,
+                     'buckets' : list(InfoMetrics.BUCKETS),
+                     'histograms' : histograms,
+                     'statuses' : dict(self.statuses),
+                     'keys' : dict([ (k, dict(v)) for (k, v) in self.keys.items() ]),
+                     'sizes' : dict(self.sizes) }
+        finally:
+            self.lock.release()
+
+    def _quantile(self, count, buckets, q, maximum):
+        '''
+        Upper bound of the bucket holding quantile q. 
+        '''
+        seen = 0
+        for (i, n) in enumerate(buckets):
+            seen += n
+            if seen >= q * count:
+                if i < len(InfoMetrics.BUCKETS):
+                    return min(InfoMetrics.BUCKETS[i], maximum)
+                return maximum
+        return maximum
+
+
+class InfoAdmission(object):
+    '''
+    Admission control in front of the API. Requests are sorted into lanes by operation, each
+    with a limit of concurrent requests. Requests beyond it wait in a queue shared by all 
+    lanes, bounded in length and waiting time. Those finding the queue full, or waiting too 
+    long, are answered 503 with a Retry-After header at once, before their body is read. 
+
+    /admin and other paths outside the lanes are never held back. fit() lowers the limits and 
+    queue to leave SPARETHREADS of the server threads free, so /admin/health and /admin/metrics
+    keep answering while the service is overloaded. 
+
+    admit() and release() are CherryPy hooks. 
+    '''
+    # default concurrent requests per lane. 
+    LIMITS = { 'read' : 10, 'write' : 4, 'pairing' : 2, 'watch' : 8 }
+    # server threads never taken by admitted or queued requests. 
+    SPARETHREADS = 2
+
+    def __init__(self, config):
+        self.log = logging.getLogger()
+        self.lock = threading.Lock()
+        try:
+            self.enabled = config.getboolean('admission', 'enabled')
+        except (NoOptionError, NoSectionError):
+            self.enabled = True
+        try:
+            self.maxqueue = config.getint('admission', 'queue')
+        except (NoOptionError, NoSectionError):
+            self.maxqueue = 4
+        try:
+            self.queuetimeout = config.getfloat('admission', 'queuetimeout')
+        except (NoOptionError, NoSectionError):
+            self.queuetimeout = 1.0
+        try:
+            self.retryafter = config.getint('admission', 'retryafter')
+        except (NoOptionError, NoSectionError):
+            self.retryafter = 1
+        # lane -> {'limit', 'running', 'waiting', 'admitted', 'queued', 'rejected'}
+        self.lanes = {}
+        self.ready = {}
+        for (lane, limit) in InfoAdmission.LIMITS.items():
+            try:
+                limit = config.getint('admission', lane)
+            except (NoOptionError, NoSectionError):
+                pass
+            self.lanes[lane] = { 'limit' : limit, 'running' : 0, 'waiting' : 0, 
+                                 'admitted' : 0, 'queued' : 0, 'rejected' : 0 }
+            self.ready[lane] = threading.Condition(self.lock)
+        self.waiting = 0
+
+    def fit(self, threads):
+        '''
+        Lowers the lane limits and queue, largest first, until together they take at most 
+        <threads> server threads less SPARETHREADS. Lanes keep a limit of at least 1. 
+        '''
+        if not self.enabled:
+            return
+        available = threads - InfoAdmission.SPARETHREADS
+        total = sum([ l['limit'] for l in self.lanes.values() ]) + self.maxqueue
+        if total <= available:
+            return
+        self.log.error("Admission limits and queue take %d of %d server threads, leaving fewer "
+                       "than %d for /admin. Lowering them." % (total, threads, InfoAdmission.SPARETHREADS))
+        while total > available:
+            lowerable = [ (l['limit'] - 1, lane) for (lane, l) in self.lanes.items() if l['limit'] > 1 ]
+            if self.maxqueue > 0:
+                lowerable.append((self.maxqueue, None))
+            if not lowerable:
+                self.log.error("Cannot fit admission limits in %d server threads." % threads)
+                break
+            (n, lane) = max(lowerable)
+            if lane is None:
+                self.maxqueue -= 1
+            else:
+                self.lanes[lane]['limit'] -= 1
+            total -= 1
+        limits = dict([ (lane, l['limit']) for (lane, l) in self.lanes.items() ])
+        self.log.warning("Admission limits now %s, queue %d." % (limits, self.maxqueue))
+
+    def getlane(self, request):
+        '''
+        Lane of a request, or None if it is never held back. 
+        '''
+        if request.script_name == '/info':
+            if request.method not in ('GET', 'HEAD'):
+                return 'write'
+            if 'pairingcode' in request.params:
+                # waiting for the cert, it is a long poll.
+                if 'wait' in request.params:
+                    return 'watch'
+                return 'pairing'
+            return 'read'
+        elif request.script_name == '/batch':
+            return 'write'
+        elif request.script_name == '/watch':
+            return 'watch'
+        return None
+
+    def admit(self):
+        request = cherrypy.serving.request
+        lane = self.getlane(request)
+        if lane is None or not self.enabled:
+            return
+        l = self.lanes[lane]
+        self.lock.acquire()
+        try:
+            if l['running'] >= l['limit']:
+                if self.waiting >= self.maxqueue:
+                    return self.reject(lane, "Too many %s requests queued." % lane)
+                self.waiting += 1
+                l['waiting'] += 1
+                l['queued'] += 1
+                try:
+                    deadline = time.time() + self.queuetimeout
+                    while l['running'] >= l['limit']:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return self.reject(lane, "Timed out waiting for %s request slot." % lane)
+                        self.ready[lane].wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    l['waiting'] -= 1
+            l['running'] += 1
+            l['admitted'] += 1
+        finally:
+            self.lock.release()
+        request.infolane = lane
+        request.hooks.attach('on_end_request', self.release)
+
+    def reject(self, lane, msg):
+        '''
+        Answers the current request 503 without running its handler. Called with the lock held.
+        '''
+        self.lanes[lane]['rejected'] += 1
+        self.log.debug("Rejected %s request: %s" % (lane, msg))
+        request = cherrypy.serving.request
+        request.handler = None
+        request.process_request_body = False
+        response = cherrypy.serving.response
+        response.status = 503
+        # spread the retries of a herd of clients rejected together. 
+        response.headers['Retry-After'] = str(random.randint(self.retryafter, 2 * self.retryafter))
+        response.body = "%s Try again later." % msg
+
+    def release(self):
+        lane = cherrypy.serving.request.infolane
+        self.lock.acquire()
+        try:
+            self.lanes[lane]['running'] -= 1
+            self.ready[lane].notify()
+        finally:
+            self.lock.release()
+
+    def getstats(self):
+        self.lock.acquire()
+        try:
+            return { 'enabled' : self.enabled,
+                     'queue' : self.maxqueue,
+                     'queuetimeout' : self.queuetimeout,
+                     'waiting' : self.waiting,
+                     'lanes' : dict([ (lane, dict(l)) for (lane, l) in self.lanes.items() ]) }
+        finally:
+            self.lock.release()
+
+
+class InfoTimedPersistence(object):
+    '''
+    Wraps persistence plugin, recording how long calls to its store and read methods take
+    as "persist.<method>" metrics. Everything else is passed through. Methods the plugin 
+    does not have, like storedocument() of the read-only InfoReplicaStore, are left out. 
+    '''
+    TIMED = ('storedocument', 'storeentity', 'storeentities', 'deleteentity', 
+             'getdocument', 'getentity', 'sync')
+
+    def __init__(self, plugin, metrics):
+        self.plugin = plugin
+        self.metrics = metrics
+        for name in InfoTimedPersistence.TIMED:
+            if hasattr(plugin, name):
+                setattr(self, name, self._timed(name, getattr(plugin, name)))
+
+    def _timed(self, name, method):
+        metric = 'persist.' + name
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.metrics.observe(metric, time.time() - start)
+        return timed
+
+    def __getattr__(self, name):
+        return getattr(self.plugin, name)
+
+
+class InfoChangeFeed(object):
+    '''
+    Recent writes per document key, as (version, entityname) with None for whole-document 
+    writes, up to maxchanges per key. Watchers of a key block on its condition until a write
+    to it is recorded. 
+    
+    Versions are bumped while holding the feed lock, so each key's changes are recorded in 
+    version order and a watcher never sees a version whose change is not yet recorded. 
+    '''
+    def __init__(self, maxchanges=1024):
+        self.lock = threading.Lock()
+        self.maxchanges = maxchanges
+        self.changes = {}
+        self.trimmed = {}
+        self.conditions = {}
+        self.waiting = 0
+        self.closed = False
+
+    def record(self, key, entityname, bump):
+        '''
+        Calls bump(key, entityname) for new version, records the change and wakes watchers of key.
+        Returns new version. 
+        '''
+        self.lock.acquire()
+        try:
+            version = bump(key, entityname)
+            ring = self.changes.setdefault(key, collections.deque())
+            ring.append((version, entityname))
+            if len(ring) > self.maxchanges:
+                self.trimmed[key] = ring.popleft()[0]
+            cond = self.conditions.get(key)
+            if cond is not None:
+                cond.notifyAll()
+            return version
+        finally:
+            self.lock.release()
+
+    def wait(self, key, since, entityname, timeout, getversion):
+        '''
+        Waits up to timeout seconds until getversion(key, entityname) is past since. 
+        Returns (version, entitynames, complete), where entitynames are those written to key 
+        since, and complete is False if whole-document writes or trimmed changes among them
+        mean that list is not all that changed. 
+        '''
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            self.waiting += 1
+            try:
+                cond = self.conditions.get(key)
+                if cond is None:
+                    cond = threading.Condition(self.lock)
+                    self.conditions[key] = cond
+                while getversion(key, entityname) <= since and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            version = getversion(key, entityname)
+            names = set()
+            complete = since >= self.trimmed.get(key, 0)
+            for (v, name) in reversed(self.changes.get(key, ())):
+                if v <= since:
+                    break
+                if name is None:
+                    complete = False
+                else:
+                    names.add(name)
+            return (version, sorted(names), complete)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        '''
+        Releases all watchers, for shutdown. 
+        '''
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for cond in self.conditions.values():
+                cond.notifyAll()
+        finally:
+            self.lock.release()
+
+
+class InfoWriter(object):
+    '''
+    Serves the InfoHandler owning the persistence plugin to the worker processes of prefork
+    mode ([netcomm] workers), over a multiprocessing.connection unix socket. 
+    
+    Workers open two kinds of connections. Call connections forward the write methods of
+    WRITES, answered with (result, status, headers, seq), where seq is the number of the last
+    change published when the call returned. A worker's subscription connection streams the
+    changes the handler publishes, in order: 
+    
+      (seq, 'change', key, entityname, version, value)  entity (or document if entityname 
+                                                         is None) after a write, None if deleted
+      (seq, 'load', key, document)                      a document the worker asked for 
+    '''
+    WRITES = set(['storeentity', 'mergeentity', 'deleteentity', 'mergepath', 'deletepath', 
+                  'batch', 'storedocument', 'mergedocument', 'deletedocument', 'takepairing'])
+    # response headers set by write methods, passed back to the worker. 
+    HEADERS = ['ETag', 'Retry-After']
+
+    def __init__(self, infohandler, address, authkey):
+        self.log = logging.getLogger()
+        self.infohandler = infohandler
+        self.address = address
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.subscribers = {}
+        self.nextid = 0
+        self.running = True
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        infohandler.publisher = self
+        t = threading.Thread(target=self.accept_loop, name='InfoWriter')
+        t.daemon = True
+        t.start()
+        self.log.debug("Writer listening on %s" % address)
+
+    def publish(self, key, entityname, version):
+        '''
+        Called by InfoHandler._written(), with the key lock held. 
+        '''
+        snapshot = self.infohandler.persist.getsnapshot()
+        if entityname is None:
+            value = snapshot.getdocument(key)
+        else:
+            try:
+                value = snapshot.getentity(key, entityname)
+            except KeyError:
+                value = None
+        self.lock.acquire()
+        try:
+            self.seq += 1
+            for queue in self.subscribers.values():
+                queue.put((self.seq, 'change', key, entityname, version, value))
+        finally:
+            self.lock.release()
+
+    def getseq(self):
+        self.lock.acquire()
+        try:
+            return self.seq
+        finally:
+            self.lock.release()
+
+    def load(self, key, subscriber):
+        '''
+        Sends document <key> to one subscriber. Returns its seq. 
+        '''
+        lock = self.infohandler.persist.locks.getlock(key)
+        self.infohandler._acquire(lock)
+        try:
+            doc = self.infohandler.persist.getsnapshot().getdocument(key)
+            self.lock.acquire()
+            try:
+                self.seq += 1
+                self.subscribers[subscriber].put((self.seq, 'load', key, doc))
+                return self.seq
+            finally:
+                self.lock.release()
+        finally:
+            lock.release()
+
+    def call(self, method, args):
+        if method not in InfoWriter.WRITES:
+            raise ValueError("Not a write method: %s" % method)
+        # write methods report status and headers through cherrypy.response, which outside 
+        # of a request is shared by all threads. 
+        cherrypy.serving.response = cherrypy._cprequest.Response()
+        result = getattr(self.infohandler, method)(*args)
+        headers = dict([ (h, cherrypy.response.headers[h]) for h in InfoWriter.HEADERS 
+                         if h in cherrypy.response.headers ])
+        return (result, cherrypy.response.status, headers)
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except Exception, e:
+                if self.running:
+                    self.log.warning("Refused writer connection. (%s)" % e)
+                continue
+            t = threading.Thread(target=self.serve, args=(conn,), name='InfoWriterConnection')
+            t.daemon = True
+            t.start()
+
+    def serve(self, conn):
+        try:
+            try:
+                msg = conn.recv()
+                if msg[0] == 'subscribe':
+                    self.stream(conn)
+                    return
+                while True:
+                    (method, args) = msg
+                    try:
+                        if method == 'load':
+                            reply = ('ok', None, self.load(*args))
+                        else:
+                            result = self.call(method, args)
+                            reply = ('ok', result, self.getseq())
+                    except Exception, e:
+                        self.log.error("Writer call %s failed: %s" % (method, traceback.format_exc()))
+                        reply = ('error', str(e), None)
+                    conn.send(reply)
+                    msg = conn.recv()
+            except (EOFError, IOError):
+                pass
+        finally:
+            conn.close()
+
+    def stream(self, conn):
+        queue = Queue.Queue()
+        self.lock.acquire()
+        try:
+            subscriber = self.nextid
+            self.nextid += 1
+            self.subscribers[subscriber] = queue
+            # versions bumped by writes not yet published are replayed harmlessly. 
+            state = (subscriber, self.seq, self.infohandler.versions.getstate())
+        finally:
+            self.lock.release()
+        self.log.debug("Worker subscribed as %d at seq %d" % (subscriber, state[1]))
+        try:
+            conn.send(state)
+            record = queue.get()
+            while record is not None:
+                conn.send(record)
+                record = queue.get()
+        finally:
+            self.lock.acquire()
+            try:
+                self.subscribers.pop(subscriber, None)
+            finally:
+                self.lock.release()
+
+    def shutdown(self):
+        self.running = False
+        self.lock.acquire()
+        try:
+            for queue in self.subscribers.values():
+                queue.put(None)
+        finally:
+            self.lock.release()
+        self.listener.close()
+        try:
+            os.remove(self.address)
+        except OSError:
+            pass
+
+
+class InfoReplicaHandler(InfoHandler):
+    '''
+    InfoHandler of a prefork worker process. Reads are served from an InfoReplicaStore, a
+    local copy of the documents kept current by the InfoWriter change stream. Writes are 
+    forwarded to the writer process, and answered once the worker's copy has caught up with 
+    them, so clients read their own writes from any worker. 
+    '''
+    def __init__(self, config, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+        super(InfoReplicaHandler, self).__init__(config)
+
+    def makeplugin(self):
+        return InfoReplicaStore(self, self.config, 'replica', self.connect())
+
+    def addindex(self, key, attributes):
+        # loaded before, so the document is read and indexed with no change applied in between.
+        self.persist.getsnapshot().getdocument(key)
+        self.persist.lock.acquire()
+        try:
+            super(InfoReplicaHandler, self).addindex(key, attributes)
+        finally:
+            self.persist.lock.release()
+
+    def connect(self, timeout=60):
+        '''
+        Connects to the writer, waiting for it to start listening. 
+        '''
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            except socket.error, e:
+                if time.time() > deadline:
+                    raise e
+                time.sleep(0.1)
+
+    def replicated(self, key, entityname, version):
+        '''
+        Bookkeeping after a change from the writer is applied, like _written(). Called by 
+        the store with its lock held. 
+        '''
+        self._reindex(key, entityname)
+        self.changes.record(key, entityname, 
+                            lambda key, entityname: self.versions.setversion(key, entityname, version))
+        self.cache.invalidate(key, entityname)
+
+    def call(self, method, *args):
+        '''
+        Calls <method> of the writer. Returns (result, seq). 
+        '''
+        try:
+            conn = self.local.conn
+        except AttributeError:
+            conn = self.connect()
+            self.local.conn = conn
+        try:
+            conn.send((method, args))
+            (outcome, result, seq) = conn.recv()
+        except (EOFError, IOError), e:
+            del self.local.conn
+            raise Exception("Lost connection to writer process. (%s)" % e)
+        if outcome != 'ok':
+            raise Exception("Writer failed %s: %s" % (method, result))
+        return (result, seq)
+
+    def forward(self, method, *args):
+        ((result, status, headers), seq) = self.call(method, *args)
+        self.persist.waitfor(seq)
+        if status is not None:
+            cherrypy.response.status = status
+        cherrypy.response.headers.update(headers)
+        return result
+
+    def storeentity(self, key, entityname, edoc):
+        return self.forward('storeentity', key, entityname, edoc)
+
+    def mergeentity(self, key, entityname, edoc, ifmatch=None):
+        return self.forward('mergeentity', key, entityname, edoc, ifmatch)
+
+    def deleteentity(self, key, entityname, ifmatch=None):
+        return self.forward('deleteentity', key, entityname, ifmatch)
+
+    def mergepath(self, key, entityname, path, jvalue, ifmatch=None):
+        return self.forward('mergepath', key, entityname, path, jvalue, ifmatch)
+
+    def deletepath(self, key, entityname, path, ifmatch=None):
+        return self.forward('deletepath', key, entityname, path, ifmatch)
+
+    def batch(self, jops):
+        return self.forward('batch', jops)
+
+    def storedocument(self, key, doc):
+        return self.forward('storedocument', key, doc)
+
+    def mergedocument(self, key, doc):
+        return self.forward('mergedocument', key, doc)
+
+    def deletedocument(self, key):
+        return self.forward('deletedocument', key)
+
+    def takepairing(self, key, pairingcode):
+        # waiting for the cert happens here, on the replicated change feed.
+        return self.forward('takepairing', key, pairingcode)
+
+
+class InfoReplicaStore(InfoPersistencePlugin):
+    '''
+    Read-only copy of the writer's documents in a prefork worker, in the place of the 
+    persistence plugin. Documents are fetched from the writer when first read, and then 
+    kept current by a thread applying its change stream. Changes to documents not fetched
+    yet only update versions. It has no write methods: InfoReplicaHandler forwards all
+    writes to the writer.
+    '''
+    def __init__(self, parent, config, section, conn):
+        super(InfoReplicaStore, self).__init__(parent, config, section)
+        self.lock = threading.Lock()
+        self.applied = threading.Condition(self.lock)
+        self.snapshot = InfoReplicaSnapshot(self)
+        self.loaded = set()
+        self.closed = False
+        self.stopping = False
+        self.stream = conn
+        self.stream.send(('subscribe',))
+        (self.subscriber, self.seq, versions) = self.stream.recv()
+        parent.versions.setstate(versions)
+        t = threading.Thread(target=self.apply_loop, name='InfoReplica')
+        t.daemon = True
+        t.start()
+        self.log.debug("Replica subscribed as %d at seq %d" % (self.subscriber, self.seq))
+
+    def getdocument(self, key):
+        return self.snapshot.getdocument(key)
+
+    def getentity(self, key, entityname):
+        return self.snapshot.getentity(key, entityname)
+
+    def getsnapshot(self):
+        return self.snapshot
+
+    def load(self, key):
+        '''
+        Returns document <key>, fetching it from the writer if not loaded yet. 
+        '''
+        if key not in self.loaded:
+            (result, seq) = self.parent.call('load', key, self.subscriber)
+            self.waitfor(seq)
+        return self.snapshot.getdocument(key)
+
+    def waitfor(self, seq):
+        '''
+        Waits until the change stream has been applied up to <seq>. 
+        '''
+        self.applied.acquire()
+        try:
+            while self.seq < seq and not self.closed:
+                self.applied.wait(1.0)
+            if self.seq < seq:
+                raise Exception("Lost change stream of writer process.")
+        finally:
+            self.applied.release()
+
+    def apply_loop(self):
+        try:
+            while True:
+                record = self.stream.recv()
+                self.applied.acquire()
+                try:
+                    self.apply(record)
+                    self.seq = record[0]
+                    self.applied.notifyAll()
+                finally:
+                    self.applied.release()
+        except (EOFError, IOError), e:
+            if not self.stopping:
+                self.log.error("Lost change stream of writer process. (%s)" % e)
+        finally:
+            self.applied.acquire()
+            try:
+                self.closed = True
+                self.applied.notifyAll()
+            finally:
+                self.applied.release()
+            if not self.stopping:
+                # without current data, stop serving. 
+                cherrypy.engine.exit()
+
+    def apply(self, record):
+        if record[1] == 'load':
+            (seq, op, key, doc) = record
+            self.snapshot = self.snapshot.withdocument(key, doc)
+            self.loaded.add(key)
+            self.parent.cache.invalidate(key)
+            return
+        (seq, op, key, entityname, version, value) = record
+        if key in self.loaded:
+            if entityname is None:
+                self.snapshot = self.snapshot.withdocument(key, value)
+            else:
+                self.snapshot = self.snapshot.withentities(key, { entityname : value })
+        self.parent.replicated(key, entityname, version)
+
+    def shutdown(self):
+        self.stopping = True
+        self.stream.close()
+
+
+class InfoReplicaSnapshot(InfoSnapshot):
+    '''
+    InfoSnapshot of an InfoReplicaStore, loading documents from the writer on first read. 
+    '''
+    def __init__(self, store, version=0, documents=None):
+        super(InfoReplicaSnapshot, self).__init__(version, documents)
+        self.store = store
+
+    def getdocument(self, key):
+        try:
+            return self.documents[key]
+        except KeyError:
+            # not loaded yet, or loaded after this snapshot was taken. 
+            return self.store.load(key)
+
+    def withdocument(self, key, doc):
+        documents = dict(self.documents)
+        documents[key] = doc
+        return InfoReplicaSnapshot(self.store, self.version + 1, documents)
+
+
+class InfoRoot(object):
+
+    @cherrypy.expose
+    def index(self):
+        return "Nothing to see. Go to /info"    
+
+    @cherrypy.expose
+    def generate(self, length=8):
+        return ''.join(random.sample(string.hexdigits, int(length)))
+
+class InfoAdmin(object):
+    '''
+    Service-internal state for operators, as JSON. Mounted at /admin. 
+    '''
+    def __init__(self, infohandler):
+        self.infohandler = infohandler
+
+    @cherrypy.expose
+    def cache(self):
+        return json.dumps(self.infohandler.cache.getstats())
+
+    @cherrypy.expose
+    def metrics(self):
+        return json.dumps(self.infohandler.metrics.getstats())
+
+    @cherrypy.expose
+    def health(self):
+        '''
+        Liveness, and which lanes of admission control are full. Never held back by it. 
+        '''
+        admission = self.infohandler.admission.getstats()
+        saturated = [ lane for (lane, l) in admission['lanes'].items() if l['running'] >= l['limit'] ]
+        return json.dumps({ 'status' : 'saturated' if saturated else 'ok', 
+                            'pid' : os.getpid(),
+                            'uptime' : time.time() - self.infohandler.metrics.started,
+                            'saturated' : sorted(saturated),
+                            'admission' : admission })
+
+
+class InfoWatchAPI(object):
+    '''
+    Long-poll change feed. Mounted at /watch. 
+    '''
+    exposed = True
+
+    def __init__(self, infohandler):
+        self.log = logging.getLogger()
+        self.infohandler = infohandler
+
+    def GET(self, key, since=None, entityname=None, timeout=None):
+        self.log.debug("Watching key %s entityname %s since %s" % (key, entityname, since))
+        if timeout is not None:
+            try:
+                timeout = float(timeout)
+                if timeout != timeout:
+                    # NaN never runs out.
+                    raise ValueError(timeout)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid timeout %s" % timeout)
+        return self.infohandler.watch(key, since, entityname, timeout)
+
+
+class InfoBatchAPI(object):
+    '''
+    Many entity operations in one request. Mounted at /batch. 
+    '''
+    exposed = True
+
+    def __init__(self, infohandler):
+        self.log = logging.getLogger()
+        self.infohandler = infohandler
+
+    def POST(self, data=None):
+        if data is None and cherrypy.request.process_request_body:
+            data = cherrypy.request.body.read()
+        if not data:
+            cherrypy.response.status = 400
+            return "No batch given."
+        return self.infohandler.batch(data)
+
+
+class InfoServiceAPI(object):
+    ''' 
+        Data at this level is assumed to be  JSON text/plain. 
+    
+    '''
+    exposed = True 
+    
+    def __init__(self, config, infohandler=None):
+        self.log = logging.getLogger()
+        self.log.debug("Initting InfoServiceAPI...")
+        if infohandler is None:
+            infohandler = InfoHandler(config)
+        self.infohandler = infohandler
+        self.log.debug("InfoServiceAPI init done." )
+    
+    def GET(self, key, pairingcode=None, entityname=None, path=None, fields=None, where=None, 
+            limit=None, after=None, stream=None, wait=None):
+        if fields is not None:
+            # comma-separated attribute names.
+            fields = [ f.strip() for f in fields.split(',') if f.strip() ]
+        if limit is not None:
+            try:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError(limit)
+            except ValueError:
+                cherrypy.response.status = 400
+                return "Invalid limit %s" % limit
+        if wait is not None:
+            try:
+                wait = float(wait)
+                if wait != wait:
+                    # NaN never runs out.
+                    raise ValueError(wait)
+            except ValueError:
+                cherrypy.response.status = 400
+                return "Invalid wait %s" % wait
+        stream = stream is not None and stream.lower() in ('1', 'true', 'yes')
+        if path is not None and entityname is None:
+            (entityname, path) = self.infohandler.splitpath(path)
+        if pairingcode is None:
+            etag = self.infohandler.getetag(key, entityname)
+            matched = self.infohandler.matchetag(etag, cherrypy.request.headers.get('If-None-Match'))
+            if matched is not None:
+                self.log.debug("Key %s entityname %s not modified since %s" % (key, entityname, etag))
+                # the representation the client has. 
+                cherrypy.response.headers['ETag'] = matched
+                cherrypy.response.status = 304
+                return ''
+        if pairingcode is None and entityname is None:
+            d = self.infohandler.getdocument(key, self.acceptencodings(), fields, where, limit, after, stream) 
+            self.log.debug("Document retrieved for key %s " % key)
+            if cherrypy.response.status is None:
+                cherrypy.response.headers['ETag'] = self.infohandler.encodedetag(etag)
+            return d
+        elif pairingcode is None and path:
+            v = self.infohandler.getpath(key, entityname, path, self.acceptencodings())
+            self.log.debug("Path %s retrieved for key %s and name %s" % (path, key, entityname))
+            if cherrypy.response.status is None:
+                cherrypy.response.headers['ETag'] = self.infohandler.encodedetag(etag)
+            return v
+        elif pairingcode is None:
+            e = self.infohandler.getentity(key, entityname, self.acceptencodings(), fields) 
+            self.log.debug("Entity retrieved for key %s and name %s" % (key,entityname))
+            if cherrypy.response.status is None:
+                cherrypy.response.headers['ETag'] = self.infohandler.encodedetag(etag)
+            return e
+        else:
+            self.log.debug("Handling pairing retrieval")
+            d = self.infohandler.getpairing(key, pairingcode, wait)
+            self.log.debug("Pairing retrieved for code %s with val %s" % (pairingcode,d))
+            return d
+
+    @cherrypy.tools.accept(media='text/plain')
+    def PUT(self, key, entityname=None, data=None, path=None):
+        rtext = "Something went wrong..."
+        data = self.requestdata(data)
+        if data is None:
+            cherrypy.response.status = 400
+            return "No data given for key %s" % key
+        if path is not None and entityname is None:
+            (entityname, path) = self.infohandler.splitpath(path)
+        if path:
+            self.log.debug("Merging key %s entityname %s path %s" % (key, entityname, path))
+            msg = self.infohandler.mergepath(key, entityname, path, data, cherrypy.request.headers.get('If-Match'))
+            if msg is not None:
+                return msg
+            rtext= "Path %s of entity %s stored in key %s\n" % (path, entityname, key )
+        elif entityname is None:
+            self.log.debug("Storing document %s" % data)
+            self.infohandler.mergedocument(key, data)
+            self.log.debug("Document stored for key %s" % key)
+            rtext= "Document stored for key %s\n" % key
+        else:
+            self.log.debug("Storing key %s entityname %s " % (key, entityname))
+            msg = self.infohandler.mergeentity(key, entityname, data, cherrypy.request.headers.get('If-Match'))
+            if msg is not None:
+                return msg
+            rtext= "Entity %s stored in key %s\n" % (entityname, key )
+        return rtext
+
+        
+    def POST(self, key, entityname=None, data=None):
+        rtext = "Something went wrong..."
+        data = self.requestdata(data)
+        if data is None:
+            cherrypy.response.status = 400
+            return "No data given for key %s" % key
+        if entityname is None:
+            self.log.debug("Storing document %s" % data)
+            self.infohandler.storedocument(key, data)
+            self.log.debug("Document stored for key %s" % key)
+            rtext= "Document stored for key %s\n" % key
+        else:
+            self.log.debug("Storing key %s entityname %s " % (key, entityname))
+            self.infohandler.storeentity(key, entityname, data)
+            rtext= "Entity %s stored in key %s\n" % (entityname, key )
+        return rtext
+        
+    def DELETE(self, key, entityname=None, path=None):
+        '''
+        Deletes specified entity from <key> document, or the subtree at path within it. 
+        '''
+        if path is not None and entityname is None:
+            (entityname, path) = self.infohandler.splitpath(path)
+        if entityname is None:
+            cherrypy.response.status = 400
+            return "No entityname or path given for key %s" % key
+        msg = self.infohandler.deletepath(key, entityname, path, cherrypy.request.headers.get('If-Match'))
+        if msg is not None:
+            return msg
+        if path:
+            rtext= "Path %s of entity %s deleted in key %s\n" % (path, entityname, key )
+        else:
+            rtext= "Entity %s deleted in key %s\n" % (entityname, key )
+        return rtext
+
 
     def stripquotes(self,s):
         rs = s.replace("'","")
         return rs
 
+    def acceptencodings(self):
+        '''
+        Returns content codings acceptable to the client, per Accept-Encoding, preferred first.
+        '''
+        return [ e.value.lower() for e in cherrypy.request.headers.elements('Accept-Encoding') if e.qvalue > 0 ]
+
+    def requestdata(self, data):
+        '''
+        Returns JSON payload of a PUT or POST: the data parameter, if given in the query string
+        or a form body, otherwise the (application/json) request body. None if there is neither. 
+        '''
+        if data is None and cherrypy.request.process_request_body:
+            data = cherrypy.request.body.read()
+        if not data:
+            return None
+        return data
+
+
+class InfoSharedSocketServer(CPWSGIServer):
+    '''
+    CherryPy HTTP server accepting on an already bound and listening socket, inherited from
+    the parent process, instead of binding its own. 
+    '''
+    def __init__(self, server_adapter, listener):
+        self.listener = listener
+        CPWSGIServer.__init__(self, server_adapter)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.listener
+        if self.ssl_adapter is not None:
+            self.socket = self.ssl_adapter.bind(self.socket)
+
+
+class InfoUnixSocketServer(InfoSharedSocketServer):
+    '''
+    InfoSharedSocketServer for a bound unix domain socket. It speaks plain HTTP without client
+    certificates: who may connect is decided by the permissions of the socket file. 
+    '''
+    def __init__(self, server_adapter, listener):
+        InfoSharedSocketServer.__init__(self, server_adapter, listener)
+        # any string bind_addr selects the AF_UNIX handling of HTTPServer, but start() unlinks
+        # the file it names before binding. The socket is bound already, so name none. 
+        self.bind_addr = ''
+        self.app = self.wsgi_app
+        self.wsgi_app = self.unixapp
+
+    def unixapp(self, environ, start_response):
+        # AF_UNIX has no port, and CherryPy 3.2 parses SERVER_PORT as an integer. 
+        environ['SERVER_PORT'] = '0'
+        return self.app(environ, start_response)
+
 
 class InfoService(object):
+    # server threads of each HTTP server. 
+    THREADPOOL = 30
+    # seconds before forking again a prefork worker that exited, doubled each time one exits
+    # within RESTARTBACKOFFMAX seconds of its start, up to that. 
+    RESTARTBACKOFF = 1.0
+    RESTARTBACKOFFMAX = 60.0
     
     def __init__(self, config):
         self.log = logging.getLogger()
@@ -457,35 +2529,44 @@ class InfoService(object):
         self.httpport = int(config.get('netcomm','httpport'))
         self.httpsport = int(config.get('netcomm','httpsport'))
         self.sslmodule = config.get('netcomm','sslmodule')
+        try:
+            self.workers = config.getint('netcomm', 'workers')
+        except (NoOptionError, NoSectionError):
+            self.workers = 0
+        try:
+            self.writersocket = os.path.expanduser(config.get('netcomm', 'writersocket'))
+        except (NoOptionError, NoSectionError):
+            self.writersocket = os.path.expanduser('~/var/infoservice-writer.sock')
+        try:
+            self.unixsocket = os.path.expanduser(config.get('netcomm', 'unixsocket'))
+        except (NoOptionError, NoSectionError):
+            self.unixsocket = None
+        try:
+            self.unixsocketmode = int(config.get('netcomm', 'unixsocketmode'), 8)
+        except (NoOptionError, NoSectionError):
+            self.unixsocketmode = 0660
         
         self.log.debug("certfile=%s" % self.certfile)
         self.log.debug("keyfile=%s" % self.keyfile)
         self.log.debug("chainfile=%s" % self.chainfile)
+        self.log.debug("unixsocket=%s" % self.unixsocket)
         
         self.log.debug('InfoService class done.')
         
     def run(self):
         self.log.debug('Infoservice running...')
+        if self.workers > 0:
+            return self.runprefork()
           
-        cherrypy.tree.mount(InfoRoot())
-        cherrypy.tree.mount(InfoServiceAPI(self.config),'/info',
-                                {'/':
-        {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}
-    })
-        #cherrypy.tree.mount(InfoServiceAPI(self.config))
-        
+        api = InfoServiceAPI(self.config)
+        self.mount(api)
         
         cherrypy.server.unsubscribe()
     
-        server1 = cherrypy._cpserver.Server()
-        server1.socket_port=self.httpsport
-        server1._socket_host='0.0.0.0'
-        server1.thread_pool=30
-        server1.ssl_module = self.sslmodule
-        server1.ssl_certificate = self.certfile
-        server1.ssl_private_key = self.keyfile
-        server1.ssl_certificate_chain = self.chainfile
+        server1 = self.makeserver()
         server1.subscribe()
+        if self.unixsocket:
+            self.makeunixserver(self.bindunix()).subscribe()
     
         #server2 = cherrypy._cpserver.Server()
         #server2.socket_port=self.httpport
@@ -493,8 +2574,191 @@ class InfoService(object):
         #server2.thread_pool=30
         #server2.subscribe()
     
+        # SIGTERM stops the engine, so persistence is flushed by handler shutdown(). 
+        cherrypy.engine.signal_handler.subscribe()
         cherrypy.engine.start()
         cherrypy.engine.block()   
+
+    def mount(self, api):
+        # admission is shared by the servers, so all admitted requests may be on any one of them. 
+        api.infohandler.admission.fit(InfoService.THREADPOOL)
+        cherrypy.engine.subscribe('stop', api.infohandler.shutdown)
+        cherrypy.config.update({'hooks.on_start_resource' : api.infohandler.metrics.start_request,
+                                'hooks.before_request_body' : api.infohandler.admission.admit,
+                                'hooks.on_end_request' : api.infohandler.metrics.end_request})
+        cherrypy.tree.mount(InfoRoot())
+        cherrypy.tree.mount(InfoAdmin(api.infohandler), '/admin')
+        cherrypy.tree.mount(InfoWatchAPI(api.infohandler), '/watch',
+                            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+        cherrypy.tree.mount(InfoBatchAPI(api.infohandler), '/batch',
+                            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+        cherrypy.tree.mount(api,'/info',
+                                {'/':
+        {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}
+    })
+        #cherrypy.tree.mount(InfoServiceAPI(self.config))
+
+    def makeserver(self):
+        server1 = cherrypy._cpserver.Server()
+        server1.socket_port=self.httpsport
+        server1._socket_host='0.0.0.0'
+        server1.thread_pool=InfoService.THREADPOOL
+        server1.ssl_module = self.sslmodule
+        server1.ssl_certificate = self.certfile
+        server1.ssl_private_key = self.keyfile
+        server1.ssl_certificate_chain = self.chainfile
+        return server1
+
+    def makeunixserver(self, listener):
+        server = cherrypy._cpserver.Server()
+        server.socket_file = self.unixsocket
+        server.thread_pool = InfoService.THREADPOOL
+        # no bind_addr: the socket is bound by bindunix(). 
+        return ServerAdapter(cherrypy.engine, InfoUnixSocketServer(server, listener))
+
+    def makesocketdir(self, path):
+        '''
+        Creates the directory of unix socket <path> and removes a stale socket there. 
+        '''
+        sockdir = os.path.dirname(path)
+        if sockdir:
+            try:
+                os.makedirs(sockdir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise e
+        if os.path.exists(path):
+            os.remove(path)
+
+    def bindunix(self):
+        '''
+        Binds and listens on unix domain socket <unixsocket> for co-located clients, which skip
+        TCP and TLS. Anyone allowed to connect by <unixsocketmode> is trusted like a client 
+        with a certificate. 
+        '''
+        self.log.info("Listening on unix socket %s with mode %o" % (self.unixsocket, self.unixsocketmode))
+        self.makesocketdir(self.unixsocket)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.unixsocket)
+        # connections are refused until listen(), so none gets in before the mode is set. 
+        os.chmod(self.unixsocket, self.unixsocketmode)
+        listener.listen(socket.SOMAXCONN)
+        return listener
+
+    def runprefork(self):
+        '''
+        Prefork mode: forks a writer process, the only one running the persistence plugin, 
+        applying the writes the workers forward. Then binds the HTTPS port, and the unix 
+        socket if any, and forks <workers> processes serving them, each with an 
+        InfoReplicaHandler. This process only supervises: a worker that exits is forked 
+        again, after a backoff while workers keep dying young. If the writer exits, the 
+        service stops with an error. 
+        '''
+        self.log.info("Starting writer and %d worker processes..." % self.workers)
+        self.makesocketdir(self.writersocket)
+        authkey = os.urandom(32)
+        # this process starts no threads, so it can fork a worker again at any time. 
+        writerpid = self.fork(self.runwriter, authkey)
+        workers = {}
+        listener = None
+        unixlistener = None
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            listener.bind(('0.0.0.0', self.httpsport))
+            listener.listen(socket.SOMAXCONN)
+            if self.unixsocket:
+                unixlistener = self.bindunix()
+            # workers wait for the writer socket. 
+            for i in range(self.workers):
+                workers[self.fork(self.runworker, listener, unixlistener, authkey)] = time.time()
+            backoff = 0
+            while True:
+                try:
+                    (pid, status) = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise e
+                if pid == writerpid:
+                    writerpid = None
+                    # workers cannot serve without it. 
+                    raise Exception("Writer process %d exited with status %d." % (pid, status))
+                started = workers.pop(pid, None)
+                if started is None:
+                    continue
+                self.log.error("Worker process %d exited with status %d." % (pid, status))
+                if time.time() - started < InfoService.RESTARTBACKOFFMAX:
+                    backoff = min(max(2 * backoff, InfoService.RESTARTBACKOFF), InfoService.RESTARTBACKOFFMAX)
+                else:
+                    backoff = 0
+                if backoff > 0:
+                    self.log.info("Restarting worker process in %.1f s..." % backoff)
+                    time.sleep(backoff)
+                workers[self.fork(self.runworker, listener, unixlistener, authkey)] = time.time()
+        finally:
+            self.log.info("Stopping worker processes...")
+            pids = workers.keys()
+            if writerpid is not None:
+                # last, so the workers' writes in progress are finished and flushed. 
+                pids.append(writerpid)
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            for l in (listener, unixlistener):
+                if l is not None:
+                    l.close()
+
+    def fork(self, target, *args):
+        '''
+        Forks a process running target(*args). It exits with status 0 when target returns, 
+        1 if it raises. Returns its pid. 
+        '''
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                target(*args)
+                status = 0
+            except:
+                self.log.error(traceback.format_exc(None))
+            finally:
+                os._exit(status)
+        return pid
+
+    def runwriter(self, authkey):
+        self.log.debug("Writer process %d starting..." % os.getpid())
+        infohandler = InfoHandler(self.config)
+        writer = InfoWriter(infohandler, self.writersocket, authkey)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                # until SIGTERM raises SystemExit.
+                signal.pause()
+        except SystemExit:
+            self.log.debug("Writer process %d stopping..." % os.getpid())
+        finally:
+            writer.shutdown()
+            infohandler.shutdown()
+
+    def runworker(self, listener, unixlistener, authkey):
+        self.log.debug("Worker process %d starting..." % os.getpid())
+        api = InfoServiceAPI(self.config, InfoReplicaHandler(self.config, self.writersocket, authkey))
+        self.mount(api)
+        cherrypy.server.unsubscribe()
+        httpserver = InfoSharedSocketServer(self.makeserver(), listener)
+        # no bind_addr: the port is taken by the parent, so CherryPy must not wait for it to be free.
+        ServerAdapter(cherrypy.engine, httpserver).subscribe()
+        if unixlistener is not None:
+            self.makeunixserver(unixlistener).subscribe()
+        cherrypy.engine.signal_handler.subscribe()
+        cherrypy.engine.start()
+        cherrypy.engine.block()
     
 
 class InfoServiceCLI(object):
@@ -2,59 +2,280 @@ import errno
 import json
 import logging
 import os
+import threading
 import time
 import tempfile
 
-from vc3infoservice.core import InfoPersistencePlugin
+from ConfigParser import NoOptionError, NoSectionError
+
+from vc3infoservice.core import InfoPersistencePlugin, InfoSnapshot
 
 class DiskDump(InfoPersistencePlugin):
-    
+    '''
+    DiskDump persistence plugin. Keeps documents in memory, backed by a JSON snapshot file
+    plus an append-only journal of the changes made since the snapshot was written.
+
+    Journal records are written by a background flusher thread as a group commit: a record
+    queued while it is idle is written at once. Records queued while it is writing are 
+    written together, flushinterval seconds after the previous write began, and never later 
+    than flushmaxdelay seconds after they were queued. With syncwrites set, sync() (and so the HTTP 
+    response) waits until the caller's records are on disk. If the journal cannot be written, 
+    the plugin fails: sync() raises for the records not written, and further writes are 
+    refused until restart. Once the journal grows past journalmaxsize bytes it is folded 
+    into a new snapshot. 
+
+    In memory, documents are published as immutable InfoSnapshots, swapped on every write, 
+    so reads take no lock. 
+    '''
     def __init__(self, parent, config, section ):
         super(DiskDump, self).__init__(parent, config, section)
-        self.documents = {}
+        self.snapshot = InfoSnapshot()
 
         try:
             self.dbname = os.path.expanduser(self.config.get('plugin-diskdump', 'filename', '~/var/infoservice.diskdump'))
         except Exception, e:
             raise e
+        self.journalname = self.dbname + '.journal'
+        self.compactname = self.dbname + '.journal.compacting'
+
+        try:
+            self.journalmaxsize = self.config.getint(section, 'journalmaxsize')
+        except (NoOptionError, NoSectionError):
+            self.journalmaxsize = 16 * 1024 * 1024
+        try:
+            self.flushinterval = self.config.getfloat(section, 'flushinterval')
+        except (NoOptionError, NoSectionError):
+            self.flushinterval = 0.05
+        try:
+            self.flushmaxdelay = self.config.getfloat(section, 'flushmaxdelay')
+        except (NoOptionError, NoSectionError):
+            self.flushmaxdelay = 1.0
+        try:
+            self.syncwrites = self.config.getboolean(section, 'syncwrites')
+        except (NoOptionError, NoSectionError):
+            self.syncwrites = True
+        self.compacting = False
 
         self.load_db()
+        self.journal = open(self.journalname, 'a')
+        if self.journal.tell() > 0:
+            # snapshot could not be written at load. Never append to a possibly partial record.
+            self.journal.write('\n')
+        self.journalsize = self.journal.tell()
+
+        # Guards snapshot swaps and the queue of journal lines not yet written. 
+        self.flushcond = threading.Condition(threading.Lock())
+        self.pending = []
+        self.pendingsince = None
+        self.lastflush = 0.0
+        self.queued = 0
+        self.flushed = 0
+        # error that stopped the journal from being written. 
+        self.failed = None
+        self.local = threading.local()
+        self.running = True
+        self.flusher = threading.Thread(target=self.flush_loop, name='DiskDumpFlusher')
+        self.flusher.daemon = True
+        self.flusher.start()
         self.log.debug("DiskDump persistence plugin initialized...")
-        
+
     def storedocument(self, key, doc):
         self.log.debug("Storing doc for key %s..." % key)
-        self.documents[key] = doc
-
-        self.store_db()
-        return self.documents[key]
+        self.store_journal({'op' : 'storedocument', 'key' : key, 'doc' : doc})
+        return doc
 
     def getdocument(self, key):
         self.log.debug("Getting doc for key %s..." % key)
+        return self.snapshot.getdocument(key)
+
+    def getentity(self, key, entityname):
+        return self.snapshot.getentity(key, entityname)
+
+    def getsnapshot(self):
+        return self.snapshot
+
+    def storeentity(self, key, entityname, entity):
+        self.log.debug("Storing entity %s for key %s..." % (entityname, key))
+        self.store_journal({'op' : 'storeentity', 'key' : key, 'name' : entityname, 'entity' : entity})
+
+    def deleteentity(self, key, entityname):
+        self.log.debug("Deleting entity %s for key %s..." % (entityname, key))
+        if entityname not in self.getdocument(key):
+            raise KeyError(entityname)
+        self.store_journal({'op' : 'deleteentity', 'key' : key, 'name' : entityname})
+
+    def storeentities(self, key, changes):
+        self.log.debug("Storing %d entity changes for key %s..." % (len(changes), key))
+        self.store_journal({'op' : 'storeentities', 'key' : key, 'changes' : changes})
+
+    def shutdown(self):
+        '''
+        Stops the flusher thread once every queued record is written. 
+        '''
+        self.log.debug("Flushing journal and stopping flusher...")
+        self.flushcond.acquire()
         try:
-            s = self.documents[key]
-        except KeyError, e:
-            s = {}
-        return s
+            self.running = False
+            self.flushcond.notifyAll()
+        finally:
+            self.flushcond.release()
+        self.flusher.join()
 
-    def deletesubtree(self, path):
-        self.log.debug("Deleting path %s..." % str(path))
+    def store_journal(self, record):
+        '''
+        Publishes a snapshot with the change applied and queues the record for the flusher. 
+        '''
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self.flushcond.acquire()
+        try:
+            if self.failed is not None:
+                raise IOError("Refusing write, journal %s failed. (%s)" % (self.journalname, self.failed))
+            self.publish_record(record)
+            if not self.running:
+                self.write_journal([line])
+                return
+            self.pending.append(line)
+            self.queued += 1
+            seq = self.queued
+            if self.pendingsince is None:
+                self.pendingsince = time.time()
+            self.local.seq = seq
+            self.flushcond.notifyAll()
+        finally:
+            self.flushcond.release()
 
-        if len(path) < 1:
-            return None
+    def sync(self):
+        '''
+        If syncwrites is set, waits until the records queued by this thread are written.
+        '''
+        if not self.syncwrites:
+            return
+        seq = getattr(self.local, 'seq', 0)
+        self.flushcond.acquire()
+        try:
+            while self.flushed < seq and self.failed is None and self.flusher.is_alive():
+                self.flushcond.wait()
+            if self.flushed < seq:
+                raise IOError("Records not written to journal %s. (%s)" % (self.journalname, 
+                                                                           self.failed or 'flusher stopped'))
+        finally:
+            self.flushcond.release()
 
-        last_dict = self.documents
+    def flush_loop(self):
+        '''
+        Flusher thread. Writes all queued records at once: right away if they were queued 
+        while it was idle, otherwise flushinterval after the previous write began (or once 
+        the oldest queued record is flushmaxdelay old). 
+        '''
+        self.flushcond.acquire()
+        try:
+            idle = True
+            while self.running or self.pending:
+                if not self.pending:
+                    idle = True
+                    self.flushcond.wait()
+                    continue
+                while self.running and not idle:
+                    now = time.time()
+                    due = min(self.lastflush + self.flushinterval, self.pendingsince + self.flushmaxdelay)
+                    if now >= due:
+                        break
+                    self.flushcond.wait(due - now)
+                idle = False
+
+                lines = self.pending
+                seq = self.queued
+                self.pending = []
+                self.pendingsince = None
+                self.lastflush = time.time()
+                documents = None
+                if self.journalsize > self.journalmaxsize and not self.compacting:
+                    # taken together with the queue, so the snapshot holds exactly the 
+                    # records written to the journal being rotated out.
+                    documents = self.snapshot.documents
+                    self.compacting = True
 
-        for key in path[0 : -1]:
-            last_dict = last_dict[key]
+                self.flushcond.release()
+                error = None
+                try:
+                    try:
+                        self.write_journal(lines)
+                    except Exception, e:
+                        error = e
+                    if documents is not None and error is None:
+                        self.rotate_journal(documents)
+                finally:
+                    self.flushcond.acquire()
+                if error is None:
+                    self.flushed = seq
+                else:
+                    # never acknowledged, and no later write is accepted. 
+                    self.log.error('Could not write %d records to journal %s. Refusing writes. (%s)' % (len(lines), 
+                                                                                                      self.journalname, 
+                                                                                                      error))
+                    self.failed = error
+                    if documents is not None:
+                        self.compacting = False
+                self.flushcond.notifyAll()
+        finally:
+            self.flushcond.release()
+        self.log.debug("Flusher stopped.")
 
-        value = last_dict[path[-1]]
-        del last_dict[path[-1]]
+    def write_journal(self, lines):
+        '''
+        Appends <lines> to the journal and fsyncs it, once per group of records. Raises if
+        they may not be on disk. 
+        '''
+        self.journal.write(''.join(lines))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journalsize = self.journal.tell()
 
-        self.store_db()
-        return value
+    def rotate_journal(self, documents):
+        '''
+        Moves the journal aside and starts a new one, then writes <documents> as the new 
+        snapshot file in the background. The rotated journal is only removed once the snapshot is safely in place.
+        '''
+        try:
+            self.log.debug("Journal %s is %d bytes, compacting..." % (self.journalname, self.journalsize))
+            self.journal.close()
+            if os.path.exists(self.compactname):
+                # an earlier compaction failed to write its snapshot. Keep its records.
+                with open(self.compactname, 'a') as outfile:
+                    with open(self.journalname, 'r') as infile:
+                        outfile.write(infile.read())
+                os.remove(self.journalname)
+            else:
+                os.rename(self.journalname, self.compactname)
+        except Exception, e:
+            self.log.warn('Diskdump journal rotation failed. (%s)', e)
+            self.compacting = False
+            return
+        finally:
+            self.journal = open(self.journalname, 'a')
+            self.journalsize = self.journal.tell()
+
+        t = threading.Thread(target=self.compact_db, args=(documents,), name='DiskDumpCompaction')
+        t.daemon = True
+        t.start()
+
+    def compact_db(self, documents):
+        try:
+            if self.store_db(self.dump_db(documents)):
+                os.remove(self.compactname)
+                self.log.debug("Compacted journal into %s" % self.dbname)
+        except Exception, e:
+            self.log.warn('Diskdump journal compaction failed. (%s)', e)
+        finally:
+            self.compacting = False
 
-    def store_db(self):
+    def dump_db(self, documents):
+        return json.dumps(documents, sort_keys=True, indent=4, separators=(',', ': ')).encode('utf-8')
 
+    def store_db(self, dump):
+        '''
+        Atomically replaces the snapshot file with <dump>. Returns True on success.
+        '''
         tmpfile = None
         try:
             tmpfile = tempfile.NamedTemporaryFile(mode = 'w', prefix = self.dbname, delete = False)
@@ -62,9 +283,10 @@ class DiskDump(InfoPersistencePlugin):
             self.log.warn('Diskdump could not be performed. Could not open temporary file. (%s)', e)
 
         try:
-            dump    = json.dumps(self.documents, sort_keys=True, indent=4, separators=(',', ': ')).encode('utf-8')
             tmpfile.write(dump)
             tmpfile.flush()
+            # on disk before it replaces the journal it was compacted from. 
+            os.fsync(tmpfile.fileno())
             tmpfile.close()
 
             towrite = len(dump)
@@ -73,16 +295,19 @@ class DiskDump(InfoPersistencePlugin):
             if towrite == written:
                 self.log.debug('renaming Diskdump %s to %s' % (tmpfile.name, self.dbname))
                 os.rename(tmpfile.name, self.dbname)
+                return True
             else:
                 self.log.warn('Diskdump could not be performed. Could not write the whole file. (%d != %d)', towrite, written)
         except Exception, e:
                 self.log.warn('Diskdump could not be performed. (%s)', e)
+        return False
 
 
     def load_db(self):
+        documents = {}
         try:
             with open(self.dbname, 'r') as infile:
-                self.documents = json.load(infile)
+                documents = json.load(infile)
         except IOError, e:
             if e.errno == errno.ENOENT:
                 self.log.warn("Could not load db file %s. (%s)" % (self.dbname, e))
@@ -91,5 +316,81 @@ class DiskDump(InfoPersistencePlugin):
         except ValueError, e:
             self.log.error("Could not load db file %s. (%s)" % (self.dbname, e))
             os.rename(self.dbname, self.dbname + '.invalid.' + time.strftime('%Y%m%d.%H%M%S'))
-            os.remove(self.dbname)
 
+        # A journal left behind by an interrupted compaction is older than the current one.
+        replayed = 0
+        for jname in [self.compactname, self.journalname]:
+            replayed += self.replay_journal(jname, documents)
+
+        if replayed > 0:
+            self.log.info("Replayed %d journal lines, writing new snapshot." % replayed)
+            if self.store_db(self.dump_db(documents)):
+                for jname in [self.compactname, self.journalname]:
+                    if os.path.exists(jname):
+                        os.remove(jname)
+        self.snapshot = InfoSnapshot(0, documents)
+
+    def replay_journal(self, jname, documents):
+        '''
+        Applies the records of journal <jname> to <documents>. Returns number of lines read.
+        '''
+        n = 0
+        try:
+            infile = open(jname, 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return n
+            raise e
+        try:
+            for line in infile:
+                n += 1
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError, e:
+                    # partial record, left by a crash mid-write.
+                    self.log.warn("Ignoring truncated record in journal %s. (%s)" % (jname, e))
+                    continue
+                try:
+                    self.apply_record(documents, record)
+                except (KeyError, TypeError), e:
+                    self.log.warn("Could not apply journal record %s. (%s)" % (record, e))
+        finally:
+            infile.close()
+        return n
+
+    def apply_record(self, documents, record):
+        '''
+        Applies journal record to <documents> in place. Only used on documents not yet published. 
+        '''
+        op = record['op']
+        if op == 'storedocument':
+            documents[record['key']] = record['doc']
+        elif op == 'storeentity':
+            documents.setdefault(record['key'], {})[record['name']] = record['entity']
+        elif op == 'deleteentity':
+            documents.get(record['key'], {}).pop(record['name'], None)
+        elif op == 'storeentities':
+            doc = documents.setdefault(record['key'], {})
+            for (name, entity) in record['changes'].items():
+                if entity is None:
+                    doc.pop(name, None)
+                else:
+                    doc[name] = entity
+        else:
+            self.log.warn("Unknown journal record operation %s" % op)
+
+    def publish_record(self, record):
+        '''
+        Swaps in a new snapshot with journal record applied. 
+        '''
+        op = record['op']
+        if op == 'storedocument':
+            self.snapshot = self.snapshot.withdocument(record['key'], record['doc'])
+        elif op == 'storeentity':
+            self.snapshot = self.snapshot.withentity(record['key'], record['name'], record['entity'])
+        elif op == 'deleteentity':
+            self.snapshot = self.snapshot.withoutentity(record['key'], record['name'])
+        elif op == 'storeentities':
+            self.snapshot = self.snapshot.withentities(record['key'], record['changes'])
@@ -1,42 +1,56 @@
 import logging
 import threading
-from vc3infoservice.core import InfoPersistencePlugin
+from vc3infoservice.core import InfoPersistencePlugin, InfoSnapshot
 
 class Memory(InfoPersistencePlugin):
     '''
     Memory persistence plugin. Takes inbound Python primitive documents and simply keeps them in memory. 
+    Documents are published as immutable snapshots, swapped on every write, so reads take no lock. 
     '''
     def __init__(self, parent, config, section ):
         super(Memory, self).__init__(parent, config, section)
         self.lock = threading.Lock()
-        self.documents = {}
+        self.snapshot = InfoSnapshot()
         self.log.debug("Memory persistence plugin initialized...")
         
     def storedocument(self, key, doc):
         self.log.debug("Storing doc for key %s..." % key)
-        self.documents[key] = doc
-
-    def getdocument(self, key):
-        self.log.debug("Getting doc for key %s..." % key)
+        self.lock.acquire()
         try:
-            s = self.documents[key]
-        except KeyError, e:
-            s = {}
-        return s
+            self.snapshot = self.snapshot.withdocument(key, doc)
+        finally:
+            self.lock.release()
 
-    def _deletesubtree(self, path):
-        self.log.debug("Deleting path %s..." % str(path))
+    def storeentity(self, key, entityname, entity):
+        self.log.debug("Storing entity %s for key %s..." % (entityname, key))
+        self.lock.acquire()
+        try:
+            self.snapshot = self.snapshot.withentity(key, entityname, entity)
+        finally:
+            self.lock.release()
 
-        if len(path) < 1:
-            return None
+    def deleteentity(self, key, entityname):
+        self.log.debug("Deleting entity %s for key %s..." % (entityname, key))
+        self.lock.acquire()
+        try:
+            self.snapshot = self.snapshot.withoutentity(key, entityname)
+        finally:
+            self.lock.release()
 
-        last_dict = self.documents
+    def storeentities(self, key, changes):
+        self.log.debug("Storing %d entity changes for key %s..." % (len(changes), key))
+        self.lock.acquire()
+        try:
+            self.snapshot = self.snapshot.withentities(key, changes)
+        finally:
+            self.lock.release()
 
-        for key in path[0 : -1]:
-            last_dict = last_dict[key]
+    def getdocument(self, key):
+        self.log.debug("Getting doc for key %s..." % key)
+        return self.snapshot.getdocument(key)
 
-        value = last_dict[path[-1]]
-        del last_dict[path[-1]]
+    def getentity(self, key, entityname):
+        return self.snapshot.getentity(key, entityname)
 
-        return value        
-       
+    def getsnapshot(self):
+        return self.snapshot
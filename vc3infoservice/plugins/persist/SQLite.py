@@ -1,20 +1,118 @@
+'''
 
+SQLite persistence plugin. Category documents are not stored as a whole: each entity
+is one row in the entities table, indexed by (key, entityname), holding the entity JSON.
+
+Entity-level operations therefore only read or write that single row. Whole documents
+are assembled from (or split into) rows on demand.
+
+'''
+
+import errno
+import json
 import logging
+import os
+import sqlite3
+import threading
+
+from ConfigParser import NoOptionError, NoSectionError
+
 from vc3infoservice.core import InfoPersistencePlugin
 
 class SQLite(InfoPersistencePlugin):
-    
+
     def __init__(self, parent, config, section ):
-        super(Memory, self).__init__(parent, config, section)
+        super(SQLite, self).__init__(parent, config, section)
+
+        try:
+            self.dbname = os.path.expanduser(self.config.get(section, 'filename'))
+        except (NoOptionError, NoSectionError):
+            self.dbname = os.path.expanduser('~/var/infoservice.sqlite')
 
+        # sqlite3 connections may not be shared between threads, so each CherryPy
+        # worker thread gets its own.
+        self.local = threading.local()
+        self.create_db()
         self.log.debug("SQLite persistence plugin initialized...")
-        
+
     def storedocument(self, key, doc):
+        '''
+        Replaces all entity rows of <key> with the entries of <doc>.
+        '''
         self.log.debug("Storing doc for key %s..." % key)
+        if not isinstance(doc, dict):
+            raise ValueError("SQLite plugin can only store dictionary documents. Key: %s" % key)
+        conn = self._getconnection()
+        with conn:
+            conn.execute('DELETE FROM entities WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO entities (key, entityname, entity) VALUES (?, ?, ?)',
+                             [ (key, ename, json.dumps(doc[ename])) for ename in doc.keys() ])
 
-        
-        
     def getdocument(self, key):
         self.log.debug("Getting doc for key %s..." % key)
+        conn = self._getconnection()
+        doc = {}
+        for (ename, ejson) in conn.execute('SELECT entityname, entity FROM entities WHERE key = ?', (key,)):
+            doc[ename] = json.loads(ejson)
+        return doc
+
+    def getentity(self, key, entityname):
+        self.log.debug("Getting entity %s for key %s..." % (entityname, key))
+        conn = self._getconnection()
+        row = conn.execute('SELECT entity FROM entities WHERE key = ? AND entityname = ?',
+                           (key, entityname)).fetchone()
+        if row is None:
+            raise KeyError(entityname)
+        return json.loads(row[0])
+
+    def storeentity(self, key, entityname, entity):
+        self.log.debug("Storing entity %s for key %s..." % (entityname, key))
+        conn = self._getconnection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO entities (key, entityname, entity) VALUES (?, ?, ?)',
+                         (key, entityname, json.dumps(entity)))
+
+    def deleteentity(self, key, entityname):
+        self.log.debug("Deleting entity %s for key %s..." % (entityname, key))
+        conn = self._getconnection()
+        with conn:
+            cur = conn.execute('DELETE FROM entities WHERE key = ? AND entityname = ?', (key, entityname))
+            if cur.rowcount < 1:
+                raise KeyError(entityname)
+
+    def storeentities(self, key, changes):
+        self.log.debug("Storing %d entity changes for key %s..." % (len(changes), key))
+        conn = self._getconnection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO entities (key, entityname, entity) VALUES (?, ?, ?)',
+                             [ (key, ename, json.dumps(entity)) for (ename, entity) in changes.items() if entity is not None ])
+            conn.executemany('DELETE FROM entities WHERE key = ? AND entityname = ?',
+                             [ (key, ename) for (ename, entity) in changes.items() if entity is None ])
+
+    def create_db(self):
+        dbdir = os.path.dirname(self.dbname)
+        if dbdir:
+            try:
+                os.makedirs(dbdir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise e
+        conn = self._getconnection()
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS entities (
+                                key TEXT NOT NULL,
+                                entityname TEXT NOT NULL,
+                                entity TEXT NOT NULL,
+                                PRIMARY KEY (key, entityname) )''')
+        self.log.debug("SQLite db %s ready." % self.dbname)
 
-        
+    def _getconnection(self):
+        try:
+            conn = self.local.conn
+        except AttributeError:
+            conn = sqlite3.connect(self.dbname, timeout=30)
+            # Write-ahead logging lets readers proceed while a row is being written.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn